@@ -0,0 +1,212 @@
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import glob
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+from llama_index.core import Settings
+
+from models.embedding_models import get_embedding_model
+from models.llm_cache import enable_llm_response_cache
+from survivorship_navigator import treatment_summarizer, generate_SCP, load_scp_resources, SCP_KB_CATEGORIES
+
+
+def load_patient_notes(input_path, id_key='patient_id', text_key='note'):
+    '''
+    Stream (patient_id, patient_note_text) pairs from either
+    - a folder of .txt files (the file name is used as the patient id), or
+    - a JSONL file with one {id_key: ..., text_key: ...} object per line.
+    '''
+    if os.path.isdir(input_path):
+        for note_file in sorted(glob.glob(os.path.join(input_path, '*.txt'))):
+            patient_id = os.path.splitext(os.path.basename(note_file))[0]
+            with open(note_file, 'r') as f:
+                yield patient_id, f.read()
+    else:
+        with open(input_path, 'r') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                patient = json.loads(line)
+                yield str(patient[id_key]), patient[text_key]
+
+
+def check_patient_id(patient_id):
+    # the id is used as the folder name under save_path, so it must be a single path component
+    if patient_id.strip() in ('', '.', '..') or '/' in patient_id or '\\' in patient_id or '\0' in patient_id:
+        raise ValueError(f'Invalid patient id {patient_id!r}, it must be a file name without path separators.')
+    return patient_id
+
+
+def load_manifest(manifest_path):
+    # the manifest is an append-only JSONL log, the last entry of a patient wins
+    patient_status = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # partially written line from an interrupted run
+                patient_status[entry['patient_id']] = entry['status']
+    return patient_status
+
+
+def process_patient(patient_id,
+                    patient_note_text,
+                    save_path,
+                    llm_model,
+                    scp_resources,
+                    use_jsonified_patient_data=True,
+                    device='cuda'):
+    # returns the sections that could not be generated
+    patient_folder = os.path.join(save_path, check_patient_id(patient_id))
+    if not os.path.exists(patient_folder):
+        os.makedirs(patient_folder)
+
+    treatment_summary_dict = treatment_summarizer(patient_note_text,llm_model,use_jsonified_patient_data=use_jsonified_patient_data)
+
+    treatment_summary_json,SCP_JSON = generate_SCP(patient_treatment_info = treatment_summary_dict,
+                                                    drug_info_kb_path = scp_resources['drug_info_kb_path'],
+                                                    scp_task_kb_path = None,
+                                                    llm_model = llm_model,
+                                                    embedding_model = None,
+                                                    reranker = None,
+                                                    is_save = True,
+                                                    save_path = patient_folder,
+                                                    device = device,
+                                                    scp_resources = scp_resources)
+
+    with open(os.path.join(patient_folder, 'SCP.json'), 'w') as f:
+        json.dump(SCP_JSON, f)
+
+    return [task for task in SCP_KB_CATEGORIES if task not in SCP_JSON]
+
+
+def run_cohort(input_path,
+               save_path,
+               drug_info_kb_path,
+               scp_task_kb_path,
+               llm_model,
+               reranker,
+               num_patient_workers=4,
+               use_jsonified_patient_data=True,
+               retry_failed=True,
+               device='cuda',
+               use_unified_kb=False):
+    '''
+    Generate SCPs for every patient note in input_path, writing each patient to save_path/<patient_id>.
+    Progress is recorded in save_path/manifest.jsonl so an interrupted run resumes with the remaining patients.
+    A patient is 'done' if all sections were generated, 'partial' if some failed and 'failed' if the SCP could not be generated.
+    Partial and failed patients are run again if retry_failed is set, notes with a patient id seen before in input_path are skipped.
+    '''
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    # knowledge bases, retrievers and the cross encoder are loaded once for the whole cohort
+    scp_resources = load_scp_resources(drug_info_kb_path, scp_task_kb_path, reranker, device=device, use_unified_kb=use_unified_kb)
+
+    manifest_path = os.path.join(save_path, 'manifest.jsonl')
+    patient_status = load_manifest(manifest_path)
+    skip_status = {'done'} if retry_failed else {'done', 'partial', 'failed'}
+    print(f"Resuming cohort run, {sum(status == 'done' for status in patient_status.values())} patients already done.")
+
+    manifest_lock = threading.Lock()
+    def write_manifest(entry):
+        with manifest_lock:
+            with open(manifest_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def run_patient(patient_id, patient_note_text):
+        start_time = time.time()
+        try:
+            missing_sections = process_patient(patient_id, patient_note_text, save_path, llm_model, scp_resources,
+                                               use_jsonified_patient_data=use_jsonified_patient_data, device=device)
+        except Exception as e:
+            print(f'SCP generation failed for patient {patient_id}: {e}')
+            write_manifest({'patient_id': patient_id, 'status': 'failed', 'time_s': round(time.time() - start_time, 2), 'error': str(e)})
+            return 'failed'
+        if len(missing_sections) > 0:
+            print(f'SCP of patient {patient_id} is missing {len(missing_sections)} sections: {missing_sections}')
+            write_manifest({'patient_id': patient_id, 'status': 'partial', 'time_s': round(time.time() - start_time, 2), 'missing_sections': missing_sections})
+            return 'partial'
+        write_manifest({'patient_id': patient_id, 'status': 'done', 'time_s': round(time.time() - start_time, 2)})
+        return 'done'
+
+    # stream the notes through a bounded pool so that only a few notes are held in memory at once
+    status_counts = {'done': 0, 'partial': 0, 'failed': 0}
+    num_skipped, num_duplicates = 0, 0
+    seen_ids = set()
+    with ThreadPoolExecutor(max_workers=num_patient_workers) as executor:
+        running = set()
+        for patient_id, patient_note_text in load_patient_notes(input_path):
+            # a second note with the same id would be written to the same folder, the first one is kept
+            if patient_id in seen_ids:
+                print(f'Duplicate patient id {patient_id} in {input_path}, skipping the note.')
+                num_duplicates += 1
+                continue
+            seen_ids.add(patient_id)
+            if patient_status.get(patient_id) in skip_status:
+                num_skipped += 1
+                continue
+            if len(running) >= num_patient_workers * 2:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    status_counts[future.result()] += 1
+            running.add(executor.submit(run_patient, patient_id, patient_note_text))
+
+        for future in running:
+            status_counts[future.result()] += 1
+
+    print(f"Cohort run finished: {status_counts['done']} done, {status_counts['partial']} partial, {status_counts['failed']} failed, "
+          f"{num_skipped} skipped, {num_duplicates} duplicate ids.")
+    print(f"Query embeddings: {scp_resources['query_embedder'].stats()}")
+    for key, retriever in scp_resources.items():
+        if key.endswith('_retriever') and hasattr(retriever, 'stats'):
+            print(f'{retriever.section_name} ({retriever.reranker.name}): {retriever.stats()}')
+
+
+if __name__ == '__main__':
+    input_path = './patient_notes' # folder of .txt notes or a .jsonl file with {"patient_id": ..., "note": ...} per line
+    save_path = './scp_results'
+    drug_info_kb_path = './kbs/chemodrugs'
+    scp_task_kb_path = './kbs/VI_2_text-embedding-3-large'
+    llm_model = 'gpt-4o'
+    num_patient_workers = 4 # use 1 for local Hugging Face models, which share a single pipeline
+    use_jsonified_patient_data = True
+    llm_cache_path = None # e.g. './llm_cache/llm_responses.sqlite' for a persistent cache of the temperature 0 LLM responses
+    use_unified_kb = False # search all categories in one KB with a filter per section instead of one KB per category
+    embedding_provider = 'azure' # 'azure' (text-embedding-3-large) or 'local' (sentence-transformers), must match the provider scp_task_kb_path was built with
+
+    if llm_cache_path is not None:
+        llm_cache = enable_llm_response_cache(db_path=llm_cache_path, max_size_mb=1024)
+
+    load_dotenv()
+    device = 'cuda'
+
+    embedding_model = get_embedding_model(embedding_provider)
+    Settings.embed_model = embedding_model
+
+    # reranker of the retrieved guideline context (top 20 of the top_KB_k candidates): 'none', 'cross-encoder' or 'colbert',
+    # or a dict with one of them per section category, e.g. {'References to helpful resources for cancer survivors': 'none', ...}
+    reranker = 'colbert'
+
+    run_cohort(input_path = input_path,
+               save_path = save_path,
+               drug_info_kb_path = drug_info_kb_path,
+               scp_task_kb_path = scp_task_kb_path,
+               llm_model = llm_model,
+               reranker = reranker,
+               num_patient_workers = num_patient_workers,
+               use_jsonified_patient_data = use_jsonified_patient_data,
+               device = device,
+               use_unified_kb = use_unified_kb)
+
+    if llm_cache_path is not None:
+        print(f'LLM response cache: {llm_cache.stats()}')
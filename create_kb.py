@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 
 import fitz 
 from PIL import Image 
@@ -8,8 +9,6 @@ from tqdm import tqdm
 
 from openai import OpenAI
 
-import base64
-
 from pydantic import BaseModel
 from llama_index.core.node_parser import SentenceSplitter
 import json
@@ -17,14 +16,23 @@ from dotenv import load_dotenv
 
 
 from llama_index.core import Settings
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
 
 from llama_index.core import Document
-from llama_index.core import VectorStoreIndex
+from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core.ingestion import run_transformations
 from llama_index.core import Settings
 
 from dotenv import load_dotenv
 
+from models.embedding_models import get_embedding_model
+from scp_utils.batch_extraction import BatchExtraction
+from scp_utils.kb_extraction import RateLimiter, ExtractionCheckpoint, ExtractionRequestPool, parse_extracted_rules, file_sha256, request_hash, render_pdf_pages, image_data_url
+from scp_utils.kb_store import EMBEDDING_IDS_FILE, export_kb_embeddings, convert_docstore_to_sqlite, export_bm25_index, has_kb_embeddings, has_colbert_tokens, ColbertTokenStore
+from scp_utils.bm25_index import has_bm25_index
+from scp_utils.chunk_filter import ChunkPrefilter, remove_running_lines
+from scp_utils.rule_dedup import MinHasher, cluster_near_duplicates, merge_rule_cluster
+from scp_utils.rerankers import ColbertReranker, export_colbert_token_embeddings
+
 ###  Helper functions
 class ExtractedInfo(BaseModel):
     information_category: str
@@ -38,11 +46,6 @@ class StructuredOutput(BaseModel):
 # sentence splitter
 sent_spilt = SentenceSplitter(chunk_size = 512, chunk_overlap=32)
 
-# Function to encode the image
-def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
-
 
 
 
@@ -50,13 +53,39 @@ def encode_image(image_path):
 
 
 
-def extract_rules_func(reference_file_path,client):
+def save_extracted_rules(pdf_file_name, pdf_hash, rules_path, extraction_tasks, checkpoint):
+    num_failed = sum(checkpoint.get(task['chunk_hash']) is None for task in extraction_tasks)
+    if num_failed > 0:
+        # the PDF is not saved, the next run resumes with the failed chunks
+        print(f'{num_failed} extraction requests failed for {pdf_file_name}, skipping it.')
+        return
+    
+    # the rules are collected in chunk order, independent of the order in which the requests finished
+    rules_dict = []
+    for task in extraction_tasks:
+        response = checkpoint.get(task['chunk_hash'])
+        try:
+            rules_dict += parse_extracted_rules(response, task['metadata'], task['source'])
+        except (KeyError, TypeError, json.JSONDecodeError) as e:
+            print(f"Could not parse the extraction for page {task['metadata']['page_number']}: {e}")
+
+    # save the extracted rules
+    with open(rules_path, 'w') as f:
+        json.dump({'rules': rules_dict, 'pdf_hash': pdf_hash}, f)
+    # drop the responses of chunks that are no longer in the PDF
+    checkpoint.compact([task['chunk_hash'] for task in extraction_tasks])
+
+
+def extract_rules_func(reference_file_path,client,max_workers=8,requests_per_minute=500,tokens_per_minute=200000,
+                       image_dpi=300,image_format='png',jpeg_quality=90,render_workers=None,prefilter_chunks=True,
+                       use_batch_api=False,batch_poll_interval_s=60):
     rule_folder = os.path.join(reference_file_path, 'extracted_rules')
     if not os.path.exists(rule_folder):
         os.makedirs(rule_folder)
     
     #get the list of pdfs in the reference folder
-    pdfs_list = glob.glob(os.path.join(reference_file_path, '*.pdf'))
+    # sorted, so that the same copy of a duplicated chunk is kept in every run
+    pdfs_list = sorted(glob.glob(os.path.join(reference_file_path, '*.pdf')))
     print('Number of pdfs:', len(pdfs_list))
     print('pdfs:', pdfs_list)
 
@@ -157,81 +186,101 @@ The extracted information should belong to the following categories:
 '''
 
 
+    system_prompt = "You are a cancer survivorship care expert. Given the following text extracted from a pdf, extract all possible information related survivorship care of cancer survivors."
+    
+    # shared by all PDFs so that the limits hold across the whole run
+    rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    # near-duplicate chunks are detected across all the PDFs of the folder
+    prefilter = ChunkPrefilter() if prefilter_chunks else None
+    
+    checkpoints = {}
+    def get_checkpoint(pdf_file_name):
+        if pdf_file_name not in checkpoints:
+            checkpoints[pdf_file_name] = ExtractionCheckpoint(os.path.join(rule_folder, f'{pdf_file_name}_checkpoint.jsonl'))
+        return checkpoints[pdf_file_name]
+    
+    # with the Batch API, the requests of all PDFs are submitted together after the PDFs are processed
+    batch_extraction = BatchExtraction(client, os.path.join(rule_folder, 'batches'), StructuredOutput, poll_interval_s=batch_poll_interval_s) if use_batch_api else None
+    batch_pdfs = []
+    if batch_extraction is not None and batch_extraction.has_submitted_batches():
+        # batches submitted by an interrupted run are collected first, their chunks are then restored from the checkpoints
+        print('Collecting the batches of the previous run...')
+        batch_extraction.wait(get_checkpoint)
+
     # extract the text and images from the pdfs and save them
-    for pdf_file in pdfs_list:
-        rules_dict = []
+    for pdf_path in pdfs_list:
         #create a folder to save the extracted rules
-        pdf_file_name = os.path.basename(pdf_file).split('.')[0]
-        if os.path.exists(os.path.join(rule_folder, f'{pdf_file_name}_extracted_rules_2.json')):
-            continue
+        pdf_file_name = os.path.basename(pdf_path).split('.')[0]
+        rules_path = os.path.join(rule_folder, f'{pdf_file_name}_extracted_rules.json')
+        # skip PDFs that were already extracted and have not changed since
+        pdf_hash = file_sha256(pdf_path)
+        if os.path.exists(rules_path):
+            with open(rules_path) as f:
+                extracted_pdf_hash = json.load(f).get('pdf_hash', pdf_hash) # rules saved before the hash was recorded are kept
+            if extracted_pdf_hash == pdf_hash:
+                print('Skipping already extracted:', pdf_file_name)
+                if prefilter is not None and 'IMG' not in pdf_file_name:
+                    # its chunks still count as seen, so their duplicates in the other PDFs are dropped as in a full run
+                    with fitz.open(pdf_path) as extracted_pdf:
+                        for page_text in remove_running_lines([page.get_text() for page in extracted_pdf]):
+                            for text_chunk in sent_spilt.split_text(page_text):
+                                prefilter.add(text_chunk)
+                continue
         
         print('Extracting rules from:', pdf_file_name,'.............')
+        # responses are checkpointed per chunk, so an interrupted or changed PDF only sends the missing chunks
+        checkpoint = get_checkpoint(pdf_file_name)
         
-        pdf_file = fitz.open(pdf_file)
+        pdf_file = fitz.open(pdf_path)
+        
+        # one extraction request per text chunk or page image, sent (or added to the batch) as soon as it is produced
+        # only the metadata and chunk hash of every request are kept, the rules are saved in chunk order once all responses are in
+        extraction_tasks = []
+        pending_hashes = []
+        request_pool = ExtractionRequestPool(client, StructuredOutput, rate_limiter=rate_limiter, max_workers=max_workers) if batch_extraction is None else None
+        def send_request(metadata, source, messages):
+            task = {'metadata': metadata, 'source': source, 'chunk_hash': request_hash(messages)}
+            extraction_tasks.append(task)
+            if checkpoint.get(task['chunk_hash']) is not None:
+                return
+            pending_hashes.append(task['chunk_hash'])
+            if batch_extraction is not None:
+                batch_extraction.add(messages, pdf_file_name, pdf_hash, metadata['page_number'], task['chunk_hash'])
+            else:
+                request_pool.submit(messages, on_response=lambda response: checkpoint.append(pdf_hash, metadata['page_number'], task['chunk_hash'], response))
         
         if 'IMG' not in pdf_file_name:
+            # running headers and footers are removed before chunking
+            page_texts = remove_running_lines([page.get_text() for page in pdf_file])
             for i in tqdm(range(len(pdf_file))):
                 
                 # extracting from text
-                page = pdf_file[i]
-                text = page.get_text()
+                text = page_texts[i]
                 
                 # split the text into chunks
                 text_chunk_list = sent_spilt.split_text(text)
                 
                 for text_chunk in text_chunk_list:
-                    
-                    temp_dict = {'metadata': {'page_number': i+1, 'doc_title': pdf_file.metadata['title']}}
-                    
+                    # empty, reference, affiliation and duplicate chunks are not sent to the LLM
+                    if prefilter is not None and not prefilter.filter(text_chunk):
+                        continue
                     edit_text_extract_prompt = text_extract_prompt.replace('[OUTPUT_FORMAT]', output_format)
-                    edit_text_extract_prompt = text_extract_prompt.replace('[TEXT]', text_chunk)
-                    
-                
-                    completion = client.beta.chat.completions.parse(
-                            model="gpt-4o-2024-08-06",
-                            temperature=0.2,
-                            response_format= StructuredOutput,
-                            messages=[
-                                {"role": "system", "content": "You are a cancer survivorship care expert. Given the following text extracted from a pdf, extract all possible information related survivorship care of cancer survivors."},
-                                {"role": "user", "content":edit_text_extract_prompt }])
-
-                    # convert to json
-                    extract_info_dict = json.loads(completion.choices[0].message.content)
+                    edit_text_extract_prompt = edit_text_extract_prompt.replace('[TEXT]', text_chunk)
                     
-                    try:
-                        for extract_info in  extract_info_dict['extracted_information']:
-                            if "No information found" in extract_info['info']:
-                                continue            
-                            else:
-                                temp_rules_dict = {}
-                                temp_rules_dict['information_category'] = extract_info['information_category']
-                                temp_rules_dict['info'] = extract_info['info']
-                                temp_rules_dict['metadata'] = temp_dict['metadata']
-                                temp_rules_dict['metadata']['keywords'] = extract_info['keywords']
-                                
-                                temp_rules_dict['source'] = text_chunk
-                                rules_dict.append(temp_rules_dict)
-                                
-                    except:
-                        pass
-                                
+                    send_request({'page_number': i+1, 'doc_title': pdf_file.metadata['title']},
+                                 text_chunk,
+                                 [
+                                    {"role": "system", "content": system_prompt},
+                                    {"role": "user", "content": edit_text_extract_prompt}])
 
         else:
-            for i in tqdm(range(len(pdf_file))):
-                page = pdf_file[i]
-                # extracting rules form images
-                pix = page.get_pixmap(dpi=300) 
-                #save to a temporary file
-                pix.save(os.path.join(reference_file_path, 'temp.png'))
-            
-                base64_image = encode_image(os.path.join(reference_file_path, 'temp.png'))
-        
-                temp_dict = {'metadata': {'page_number': i+1, 'doc_title': pdf_file.metadata['title']}}
-        
-        
-       
-                messages =  [
-        {"role": "system", "content": "You are a cancer survivorship care expert. Given the following text extracted from a pdf, extract all possible information related survivorship care of cancer survivors."},
+            # pages are rendered in memory in a process pool and each page is sent as it arrives, so only the pages
+            # rendered ahead and the requests in flight hold an image
+            for i, image_bytes in tqdm(render_pdf_pages(pdf_path, dpi=image_dpi, image_format=image_format, jpeg_quality=jpeg_quality, num_workers=render_workers), total=len(pdf_file)):
+                send_request({'page_number': i+1, 'doc_title': pdf_file.metadata['title']},
+                             None, # the source quoted by the model is used for images
+                             [
+        {"role": "system", "content": system_prompt},
         {
         "role": "user",
         "content": [
@@ -242,60 +291,44 @@ The extracted information should belong to the following categories:
             {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}"
+                "url": image_data_url(image_bytes, image_format)
             }
             }
         ]
-        }]
-    
-                # response = requests.post("https://api.openai.com/v1/beta/chat/completions/parse/", headers=headers, json=payload)
-                response = client.beta.chat.completions.parse(
-                            model="gpt-4o-2024-08-06",
-                            temperature=0.2,
-                            response_format= StructuredOutput,
-                            messages = messages)
-                            
-                # convert to json
-                extract_info_dict = json.loads(response.choices[0].message.content)
-                # print(extract_info_dict)
-                # try:
-                for extract_info in  extract_info_dict['extracted_information']:
-                    
-                    if "No information found" in extract_info['info']:
-                        # print('No information found')
-                        continue            
-                    else:
-                        # print('Information found')
-                        temp_rules_dict = {}
-                        temp_rules_dict['information_category'] = extract_info['information_category']
-                        temp_rules_dict['info'] = extract_info['info']
-                        temp_rules_dict['metadata'] = temp_dict['metadata']
-                        temp_rules_dict['metadata']['keywords'] = extract_info['keywords']
-
-                        temp_rules_dict['source'] = extract_info['source']
-                        # print(temp_rules_dict)
-                        rules_dict.append(temp_rules_dict)
-                # except:
-                #     pass
-            
-
+        }])
         
-        # print(rules_dict)
         pdf_file.close()
+        
+        if batch_extraction is not None:
+            # the requests were written to the batch files, and the rules are saved once the batches are done
+            print(f'{len(extraction_tasks) - len(pending_hashes)} chunks restored from the checkpoint, added {len(pending_hashes)} extraction requests to the batch')
+            batch_pdfs.append((pdf_file_name, pdf_hash, rules_path, extraction_tasks))
+            continue
+        
+        # wait for the requests that are still running
+        request_pool.close()
+        print(f'{len(extraction_tasks) - len(pending_hashes)} chunks restored from the checkpoint, sent {len(pending_hashes)} extraction requests with {max_workers} workers')
+        save_extracted_rules(pdf_file_name, pdf_hash, rules_path, extraction_tasks, checkpoint)
+    
+    if batch_extraction is not None:
+        batch_extraction.submit()
+        batch_extraction.wait(get_checkpoint)
+        for pdf_file_name, pdf_hash, rules_path, extraction_tasks in batch_pdfs:
+            save_extracted_rules(pdf_file_name, pdf_hash, rules_path, extraction_tasks, get_checkpoint(pdf_file_name))
     
-        # save the extracted rules
-        with open(os.path.join(rule_folder, f'{pdf_file_name}_extracted_rules.json'), 'w') as f:
-            json.dump({'rules': rules_dict}, f)
+    if prefilter is not None:
+        prefilter.report()
 
 
-def split_rules_into_knowledge_bases(extracted_rules_path,save_path,group_lists):
+def split_rules_into_knowledge_bases(extracted_rules_path,save_path,group_lists,dedup_threshold=0.7):
     '''
     Split the extracted rules into multiple knowledge bases based on the groups.
-    
+    Near-duplicate rules of a group (shingle Jaccard similarity >= dedup_threshold) are merged into one entry that keeps
+    the sources of all of them, set dedup_threshold=None to keep every rule.
     '''        
     group_wise_separated_kb = {group: [] for group in group_lists}
     
-    rules_files = glob.glob(extracted_rules_path + '/*.json')
+    rules_files = sorted(glob.glob(extracted_rules_path + '/*.json'))
     
     for file in tqdm(rules_files):
         with open(file) as f:
@@ -313,13 +346,43 @@ def split_rules_into_knowledge_bases(extracted_rules_path,save_path,group_lists)
             else:
                 group_wise_separated_kb['Additional Information'].append(rule_temp_dict)
 
+    if dedup_threshold is not None:
+        min_hasher = MinHasher()
+        for group in group_lists:
+            kb_docs = group_wise_separated_kb[group]
+            clusters = cluster_near_duplicates([kb_doc['text'] for kb_doc in kb_docs], threshold=dedup_threshold, min_hasher=min_hasher)
+            group_wise_separated_kb[group] = [merge_rule_cluster([kb_docs[i] for i in cluster]) for cluster in clusters]
+            print(f'{group}: merged {len(kb_docs)} rules into {len(clusters)} ({len(kb_docs) - len(clusters)} near-duplicates removed)')
+
     # save the separated knowledge
     with open(os.path.join(save_path, 'group_wise_separated_knowledge.json'), 'w') as f: 
         json.dump(group_wise_separated_kb, f, indent=4)
         print(f'Group wise separated knowledge saved to {os.path.join(save_path, "group_wise_separated_knowledge.json")}')   
 
 
-def create_and_store_vector_index_for_KB(processed_knowledge_path,save_vector_index_path):
+def kb_doc_id(doc):
+    # stable id from the content of a knowledge entry, unchanged entries keep their id (and nodes) across builds
+    return hashlib.sha256(json.dumps({'text': doc['text'], 'metadata': doc['metadata']}, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_persisted_kb_index(KB_path):
+    # persisted index of an incremental build, None if it does not exist or was embedded with another model
+    if not os.path.exists(os.path.join(KB_path, 'docstore.json')) or not has_kb_embeddings(KB_path):
+        return None
+    with open(os.path.join(KB_path, EMBEDDING_IDS_FILE)) as f:
+        embed_model_name = json.load(f).get('embed_model')
+    if embed_model_name != Settings.embed_model.model_name:
+        print(f'{KB_path} was embedded with {embed_model_name}, rebuilding it with {Settings.embed_model.model_name}')
+        return None
+    return load_index_from_storage(StorageContext.from_defaults(persist_dir=KB_path))
+
+
+def create_and_store_vector_index_for_KB(processed_knowledge_path,save_vector_index_path,colbert_reranker=None,incremental=False):
+    '''
+    Create and persist the vector index of every knowledge base.
+    With incremental=True, an existing index is updated in place: entries are identified by a hash of their content,
+    so only added or changed entries are embedded and removed ones are deleted.
+    '''
     # read the knowledge base
     with open(processed_knowledge_path, 'r') as f:
         knowledge_base = json.load(f)
@@ -328,14 +391,44 @@ def create_and_store_vector_index_for_KB(processed_knowledge_path,save_vector_in
     
     for main_key in tqdm(main_keys):
         
-        kb_docs = [Document(text=doc['text'],metadata=doc['metadata'],excluded_embed_metadata_keys=["page_number","information_category","source"]) for doc in knowledge_base[main_key]]
-        kb_index = VectorStoreIndex.from_documents(kb_docs)
+        kb_docs = {}
+        for doc in knowledge_base[main_key]:
+            kb_docs.setdefault(kb_doc_id(doc), Document(id_=kb_doc_id(doc),text=doc['text'],metadata=doc['metadata'],excluded_embed_metadata_keys=["page_number","information_category","source","merged_sources"],
+                                                        # the source texts are too long for the metadata of a chunk
+                                                        excluded_llm_metadata_keys=["source","merged_sources"]))
+        save_vector_index_path_sub = os.path.join(save_vector_index_path,main_key)
+        
+        kb_index = load_persisted_kb_index(save_vector_index_path_sub) if incremental else None
+        if kb_index is None:
+            kb_index = VectorStoreIndex.from_documents(list(kb_docs.values()))
+        else:
+            # diff against the persisted index, indexes built before the content ids were used are replaced entirely
+            persisted_ids = set(kb_index.ref_doc_info.keys())
+            removed_ids = [doc_id for doc_id in persisted_ids if doc_id not in kb_docs]
+            added_docs = [doc for doc_id, doc in kb_docs.items() if doc_id not in persisted_ids]
+            print(f'{main_key}: {len(added_docs)} added, {len(removed_ids)} removed, {len(kb_docs) - len(added_docs)} unchanged')
+            if len(added_docs) == 0 and len(removed_ids) == 0 and has_bm25_index(save_vector_index_path_sub) \
+                    and (colbert_reranker is None or (has_colbert_tokens(save_vector_index_path_sub) and colbert_reranker.is_compatible(ColbertTokenStore(save_vector_index_path_sub)))):
+                continue
+            for doc_id in removed_ids:
+                kb_index.delete_ref_doc(doc_id, delete_from_docstore=True)
+            # the added entries are split and embedded together, in batches of the embedding model
+            kb_index.insert_nodes(run_transformations(added_docs, Settings.transformations))
+            for doc in added_docs:
+                kb_index.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
         
         # store the vector index
-        save_vector_index_path_sub = os.path.join(save_vector_index_path,main_key)
         if not os.path.exists(save_vector_index_path_sub):
             os.makedirs(save_vector_index_path_sub)
         kb_index.storage_context.persist(persist_dir=save_vector_index_path_sub)
+        # store the embeddings as a compact matrix and the nodes in SQLite, both memory-mapped by create_KB_retriever
+        export_kb_embeddings(save_vector_index_path_sub, index=kb_index)
+        convert_docstore_to_sqlite(save_vector_index_path_sub, docstore=kb_index.docstore)
+        # sparse BM25 index over the node text and keywords, fused with the dense retrieval
+        export_bm25_index(save_vector_index_path_sub)
+        # precompute the ColBERT token embeddings of the nodes so that reranking only encodes the query
+        if colbert_reranker is not None:
+            export_colbert_token_embeddings(save_vector_index_path_sub, colbert_reranker)
             
 
    
@@ -355,7 +448,11 @@ if __name__ == '__main__':
     client = OpenAI(api_key=OPENAI_API_KEY)
     
     ### Extract rules from the guidelines #####
-    extract_rules_func(reference_file_path,client)
+    # concurrent requests, limited to the requests and tokens per minute of the OpenAI account
+    # page images of IMG PDFs are rendered in memory, 'png' or 'jpeg' (smaller uploads, set jpeg_quality)
+    # use_batch_api=True submits all extraction requests as OpenAI batches (lower cost, results within 24h) and waits for them
+    extract_rules_func(reference_file_path,client,max_workers=8,requests_per_minute=500,tokens_per_minute=200000,
+                       image_dpi=300,image_format='png',jpeg_quality=90,use_batch_api=False)
     
     #### Create and store vector index for the knowledge bases #####
     processed_knowledge_path = os.path.join(reference_file_path, 'group_wise_separated_knowledge.json')
@@ -374,7 +471,8 @@ if __name__ == '__main__':
                 'References to helpful resources for cancer survivors',
                 'Additional Information']
 
-    split_rules_into_knowledge_bases(rules_path,save_path,group_lists)
+    # near-duplicate rules from overlapping guidelines are merged into one entry per group
+    split_rules_into_knowledge_bases(rules_path,save_path,group_lists,dedup_threshold=0.7)
 
 
     #### Create and store vector index for the knowledge bases #####
@@ -382,17 +480,16 @@ if __name__ == '__main__':
     save_vector_index_path = os.path.join(save_path, 'vector_kbs')
     
     
-    load_dotenv()
-    
-    api_key = os.getenv('AZURE_OPENAI_API_KEY')
-    azure_endpoint = os.getenv('OPENAI_API_BASE')
-    api_version = os.getenv('OPENAI_API_VERSION')
-    
-    azure_embedding_model = 'text-embedding-3-large'
+    # 'azure' (text-embedding-3-large) or 'local' (sentence-transformers on CPU, no network access needed)
+    embedding_provider = 'azure'
+    Settings.embed_model = get_embedding_model(embedding_provider)
+    # ColBERT model of the reranker, set to None to skip precomputing the node token embeddings
+    colbert_reranker = ColbertReranker(model_name='colbert-ir/colbertv2.0', device='cpu')
     
     if not os.path.exists(save_vector_index_path):
         os.makedirs(save_vector_index_path)
         
-    create_and_store_vector_index_for_KB(processed_knowledge_path,save_vector_index_path)
+    # only embed the entries that were added or changed since the last build
+    create_and_store_vector_index_for_KB(processed_knowledge_path,save_vector_index_path,colbert_reranker=colbert_reranker,incremental=True)
     
     print('Knowledge bases created and stored in vector index')
\ No newline at end of file
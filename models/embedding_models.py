@@ -0,0 +1,117 @@
+import os
+from typing import Any, List, Optional
+
+from dotenv import load_dotenv
+from pydantic import Field, PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+
+# instruction of the English bge v1.5 models for short queries that retrieve passages, the passages are embedded without it
+BGE_QUERY_INSTRUCTION = 'Represent this sentence for searching relevant passages: '
+
+
+def default_query_instruction(model_name):
+    name = model_name.lower()
+    return BGE_QUERY_INSTRUCTION if 'bge-' in name and '-en' in name else None
+
+
+class LocalSentenceTransformerEmbedding(BaseEmbedding):
+    '''
+    Local sentence-transformers embedding model for building and querying the KBs without the Azure embedding service.
+    backend='onnx' runs the model with ONNX Runtime (requires `pip install sentence-transformers[onnx]`),
+    and quantize=True additionally exports and uses a dynamically int8-quantized ONNX model for faster CPU inference.
+    Queries are prefixed with query_instruction, by default the bge query instruction for the English bge models
+    and none for other (symmetric) models, texts are embedded without it.
+    '''
+    device: str = Field(default='cpu', description='Device to run the model on.')
+    backend: str = Field(default='torch', description="'torch' or 'onnx'.")
+    quantize: bool = Field(default=False, description='Use a dynamically int8-quantized ONNX model.')
+    quantization_config: str = Field(default='avx2', description="ONNX Runtime quantization config, e.g. 'avx2', 'avx512_vnni', 'arm64'.")
+    cache_folder: Optional[str] = Field(default='./local_embedding_models', description='Folder for the exported quantized models.')
+    query_instruction: Optional[str] = Field(default=None, description='Prefix of the queries, None for no instruction.')
+
+    _model: Any = PrivateAttr()
+
+    def __init__(self, model_name='BAAI/bge-small-en-v1.5', device='cpu', backend='torch', quantize=False,
+                 quantization_config='avx2', cache_folder='./local_embedding_models', embed_batch_size=64, query_instruction='default', **kwargs):
+        if query_instruction == 'default':
+            query_instruction = default_query_instruction(model_name)
+        super().__init__(model_name=model_name, device=device, backend=backend, quantize=quantize,
+                         quantization_config=quantization_config, cache_folder=cache_folder,
+                         embed_batch_size=embed_batch_size, query_instruction=query_instruction, **kwargs)
+        from sentence_transformers import SentenceTransformer
+
+        if quantize:
+            self._model = self._load_quantized_model()
+        else:
+            self._model = SentenceTransformer(model_name, device=device, backend=backend)
+
+    def _load_quantized_model(self):
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+        # the quantized model is exported once next to a local copy of the model and reused afterwards
+        save_dir = os.path.join(self.cache_folder, self.model_name.replace('/', '__'))
+        file_name = f'onnx/model_qint8_{self.quantization_config}.onnx'
+        if not os.path.exists(os.path.join(save_dir, file_name)):
+            print(f'Exporting int8 quantized ONNX model for {self.model_name} to {save_dir}...')
+            model = SentenceTransformer(self.model_name, device=self.device, backend='onnx')
+            model.save(save_dir)
+            export_dynamic_quantized_onnx_model(model, self.quantization_config, save_dir)
+        return SentenceTransformer(save_dir, device=self.device, backend='onnx', model_kwargs={'file_name': file_name})
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'LocalSentenceTransformerEmbedding'
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self._model.encode(texts, batch_size=self.embed_batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        return embeddings.tolist()
+
+    def _format_query(self, query: str) -> str:
+        return query if self.query_instruction is None else self.query_instruction + query
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._encode([self._format_query(query)])[0]
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        # batched query embeddings with the query instruction, used by QueryEmbeddingBatcher
+        return self._encode([self._format_query(query) for query in queries])
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+
+def get_embedding_model(provider='azure', model_name=None, **kwargs):
+    '''
+    Embedding model used to build and query the KBs.
+    provider: 'azure' (Azure OpenAI deployment, configured from .env) or 'local' (LocalSentenceTransformerEmbedding).
+    A KB must be queried with the same embedding model it was built with.
+    '''
+    if provider == 'azure':
+        from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+
+        load_dotenv()
+        model_name = model_name if model_name is not None else 'text-embedding-3-large'
+        return AzureOpenAIEmbedding(
+                        model=model_name,
+                        deployment_name=kwargs.pop('deployment_name', model_name),
+                        api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+                        azure_endpoint=os.getenv('OPENAI_API_BASE'),
+                        api_version=os.getenv('OPENAI_API_VERSION'),
+                        **kwargs,
+                    )
+    elif provider == 'local':
+        if model_name is not None:
+            kwargs['model_name'] = model_name
+        return LocalSentenceTransformerEmbedding(**kwargs)
+    else:
+        raise ValueError(f"Unknown embedding provider {provider}, expected 'azure' or 'local'.")
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class LLMResponseCache():
+    '''
+    Persistent LLM response cache stored in SQLite.
+    Entries are keyed by a hash of (model, preamble, prompt, temperature) and the least recently
+    used entries are evicted once the stored responses exceed max_size_mb.
+    Sampled responses (temperature > 0 or do_sample) are only cached with cache_sampled=True, since a cached sample
+    would otherwise be returned for every later call instead of a new sample.
+    '''
+    def __init__(self, db_path = './llm_cache/llm_responses.sqlite', max_size_mb = 1024, cache_sampled = False):
+        self.db_path = db_path
+        self.max_size_bytes = int(max_size_mb * 1024**2)
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path) and not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                response TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_access REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._conn.commit()
+        self._total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(model, prompt_preamble, prompt, temperature):
+        key_data = json.dumps([str(model), prompt_preamble, prompt, float(temperature)], ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, response):
+        if response is None:
+            return
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                               (key, response, size, time.time()))
+            self._total_size += size - (row[0] if row is not None else 0)
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # drop the least recently used entries until the cache fits in max_size_bytes
+        self._total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        rows = self._conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC')
+        evict_keys = []
+        for key, size in rows:
+            if self._total_size <= self.max_size_bytes:
+                break
+            evict_keys.append((key,))
+            self._total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', evict_keys)
+        self.evictions += len(evict_keys)
+
+    def stats(self):
+        with self._lock:
+            num_entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        num_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / num_lookups if num_lookups > 0 else 0.0,
+                'evictions': self.evictions,
+                'entries': num_entries,
+                'size_mb': self._total_size / 1024**2}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+            self._total_size = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# process-wide cache used by the LLM call functions, disabled unless enabled explicitly
+_llm_response_cache = None
+
+
+def enable_llm_response_cache(db_path = './llm_cache/llm_responses.sqlite', max_size_mb = 1024, cache_sampled = False):
+    global _llm_response_cache
+    _llm_response_cache = LLMResponseCache(db_path=db_path, max_size_mb=max_size_mb, cache_sampled=cache_sampled)
+    return _llm_response_cache
+
+
+def disable_llm_response_cache():
+    global _llm_response_cache
+    if _llm_response_cache is not None:
+        _llm_response_cache.close()
+    _llm_response_cache = None
+
+
+def get_llm_response_cache(temperature = 0, do_sample = False):
+    # the cache for a call with these sampling settings, None if it is disabled or the call is sampled
+    if _llm_response_cache is None:
+        return None
+    if (temperature > 0 or do_sample) and not _llm_response_cache.cache_sampled:
+        return None
+    return _llm_response_cache
@@ -1,9 +1,15 @@
 import re
-from openai import AzureOpenAI
+import gc
+import time
+import asyncio
+import threading
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import httpx
 from typing import OrderedDict
 from dotenv import dotenv_values, load_dotenv
 import os
 
+import psutil
 import torch
 from transformers import pipeline
 import urllib.request
@@ -11,6 +17,10 @@ import json
 import os
 import ssl
 
+from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+
+from models.llm_cache import get_llm_response_cache
+
 
 def load_env_vars() -> OrderedDict:
     if os.path.exists(".env"):
@@ -19,22 +29,130 @@ def load_env_vars() -> OrderedDict:
 
     return config
 
+# long-lived clients keyed by (endpoint, deployment, api_version) so that calls share warm keep-alive connections
+_azure_openai_clients = {}
+_azure_openai_clients_lock = threading.Lock()
+# async clients are bound to the event loop they are created in, so they are cached per loop,
+# keyed by (endpoint, deployment, api_version, id(loop)) and stored with their loop so the id is not reused while cached
+_azure_openai_async_clients = {}
+# id(loop) -> (loop, async generator) that closes the async clients of the loop when it shuts down
+_azure_openai_loop_shutdown_hooks = {}
+
+
+def get_azure_openai_client(config, max_connections=None):
+    api_base = config["OPENAI_API_BASE"]
+    api_version = config["OPENAI_API_VERSION"]
+    api_key = config["AZURE_OPENAI_API_KEY"]
+    chat_completion_deployment = config["AZURE_OPENAI_DEPLOYMENT"]
+    if max_connections is None:
+        max_connections = int(config.get("AZURE_OPENAI_MAX_CONNECTIONS") or 32)
+    
+    client_key = (api_base, chat_completion_deployment, api_version)
+    
+    with _azure_openai_clients_lock:
+        if client_key not in _azure_openai_clients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            _azure_openai_clients[client_key] = AzureOpenAI(
+                api_key=api_key, 
+                azure_endpoint=api_base,
+                azure_deployment=chat_completion_deployment,
+                api_version=api_version,
+                http_client=DefaultHttpxClient(limits=limits),
+                )
+        
+    return _azure_openai_clients[client_key]
+
+
+async def _close_async_clients_on_loop_shutdown():
+    # asyncio.run closes the async generators of its loop (shutdown_asyncgens) before closing the loop,
+    # so the async clients are closed in the loop they belong to
+    try:
+        yield
+    finally:
+        with _azure_openai_clients_lock:
+            _azure_openai_loop_shutdown_hooks.pop(id(asyncio.get_running_loop()), None)
+        await aclose_azure_openai_clients()
+
+
+async def get_azure_openai_async_client(config, max_connections=None):
+    api_base = config["OPENAI_API_BASE"]
+    api_version = config["OPENAI_API_VERSION"]
+    api_key = config["AZURE_OPENAI_API_KEY"]
+    chat_completion_deployment = config["AZURE_OPENAI_DEPLOYMENT"]
+    if max_connections is None:
+        max_connections = int(config.get("AZURE_OPENAI_MAX_CONNECTIONS") or 32)
+    
+    loop = asyncio.get_running_loop()
+    client_key = (api_base, chat_completion_deployment, api_version, id(loop))
+    
+    shutdown_hook = None
+    with _azure_openai_clients_lock:
+        # clients of loops that were closed without closing them can no longer be used or closed
+        for key in [key for key, (client_loop, _) in _azure_openai_async_clients.items() if client_loop.is_closed()]:
+            del _azure_openai_async_clients[key]
+        for loop_id in [loop_id for loop_id, (hook_loop, _) in _azure_openai_loop_shutdown_hooks.items() if hook_loop.is_closed()]:
+            del _azure_openai_loop_shutdown_hooks[loop_id]
+        
+        if client_key not in _azure_openai_async_clients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            _azure_openai_async_clients[client_key] = (loop, AsyncAzureOpenAI(
+                api_key=api_key, 
+                azure_endpoint=api_base,
+                azure_deployment=chat_completion_deployment,
+                api_version=api_version,
+                http_client=DefaultAsyncHttpxClient(limits=limits),
+                ))
+        if id(loop) not in _azure_openai_loop_shutdown_hooks:
+            shutdown_hook = _close_async_clients_on_loop_shutdown()
+            _azure_openai_loop_shutdown_hooks[id(loop)] = (loop, shutdown_hook)
+    if shutdown_hook is not None:
+        # started once, so that the loop finalizes it on shutdown
+        await shutdown_hook.__anext__()
+        
+    return _azure_openai_async_clients[client_key][1]
+
+
+async def aclose_azure_openai_clients():
+    # close the async clients of the running event loop and their connections
+    loop = asyncio.get_running_loop()
+    with _azure_openai_clients_lock:
+        keys = [key for key, (client_loop, _) in _azure_openai_async_clients.items() if client_loop is loop]
+        clients = [_azure_openai_async_clients.pop(key)[1] for key in keys]
+    for client in clients:
+        await client.close()
+
+
+def close_azure_openai_clients():
+    # close the pooled clients and their connections, async clients are closed in their event loop if it is not running
+    # (call aclose_azure_openai_clients from within a running loop, asyncio.run closes them when it shuts down the loop)
+    with _azure_openai_clients_lock:
+        for client in _azure_openai_clients.values():
+            client.close()
+        _azure_openai_clients.clear()
+        async_clients = [(key, client_loop, client) for key, (client_loop, client) in _azure_openai_async_clients.items()
+                         if not client_loop.is_running()]
+        for key, _, _ in async_clients:
+            del _azure_openai_async_clients[key]
+    for _, client_loop, client in async_clients:
+        if not client_loop.is_closed():
+            client_loop.run_until_complete(client.close())
+
+
 def azure_open_ai_call(config, 
                        prompt,
                        prompt_preamble = "You are an oncologist. Answer based on the given clinical note for a patient.",
                        temperature = 0 ):
-    api_base = config["OPENAI_API_BASE"]
-    api_version = config["OPENAI_API_VERSION"]
-    api_key = config["AZURE_OPENAI_API_KEY"]
     chat_completion_deployment = config["AZURE_OPENAI_DEPLOYMENT"]
 
+    # reuse a stored response for the same deployment, preamble, prompt and temperature (only temperature 0 by default)
+    cache = get_llm_response_cache(temperature)
+    if cache is not None:
+        cache_key = cache.make_key(chat_completion_deployment, prompt_preamble, prompt, temperature)
+        response = cache.get(cache_key)
+        if response is not None:
+            return response
 
-    client = AzureOpenAI(
-        api_key=api_key, 
-        azure_endpoint=api_base,
-        azure_deployment=chat_completion_deployment,
-        api_version=api_version,
-        )
+    client = get_azure_openai_client(config)
     
 
     completion = client.chat.completions.create(
@@ -52,6 +170,44 @@ def azure_open_ai_call(config,
             
     
     response = completion.choices[0].message.content
+    if cache is not None:
+        cache.set(cache_key, response)
+
+    return response
+
+
+async def azure_open_ai_call_async(config, 
+                                   prompt,
+                                   prompt_preamble = "You are an oncologist. Answer based on the given clinical note for a patient.",
+                                   temperature = 0 ):
+    # same as azure_open_ai_call, with the async client of the running event loop
+    chat_completion_deployment = config["AZURE_OPENAI_DEPLOYMENT"]
+
+    cache = get_llm_response_cache(temperature)
+    if cache is not None:
+        cache_key = cache.make_key(chat_completion_deployment, prompt_preamble, prompt, temperature)
+        response = cache.get(cache_key)
+        if response is not None:
+            return response
+
+    client = await get_azure_openai_async_client(config)
+
+    completion = await client.chat.completions.create(
+        model=chat_completion_deployment,
+        messages=[{
+            "role": "system",
+            "content":prompt_preamble,
+        },
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }],
+        temperature=temperature,
+    )
+    
+    response = completion.choices[0].message.content
+    if cache is not None:
+        cache.set(cache_key, response)
 
     return response
 
@@ -74,23 +230,84 @@ def get_azure_openai_embedding_model(config):
 
 
 
+# process-wide cache of loaded text-generation pipelines keyed by (model_name_or_path, device)
+# so the weights are read from disk once and shared across pipeline stages and patients
+_hf_pipelines = {}
+_hf_pipeline_stats = {}
+_hf_pipelines_lock = threading.Lock()
+
+
+def load_hugging_face_pipeline(model_name_or_path, device = 'cuda'):
+    pipeline_key = (model_name_or_path, device)
+    with _hf_pipelines_lock:
+        if pipeline_key not in _hf_pipelines:
+            process = psutil.Process()
+            rss_before = process.memory_info().rss
+            start_time = time.perf_counter()
+            
+            _hf_pipelines[pipeline_key] = pipeline(
+                "text-generation",
+                model=model_name_or_path,
+                model_kwargs={"torch_dtype": torch.bfloat16},
+                device=device
+            )
+            
+            _hf_pipeline_stats[pipeline_key] = {
+                'load_time_s': time.perf_counter() - start_time,
+                'rss_delta_mb': (process.memory_info().rss - rss_before) / 1024**2,
+                'rss_mb': process.memory_info().rss / 1024**2,
+            }
+            if torch.cuda.is_available():
+                _hf_pipeline_stats[pipeline_key]['cuda_allocated_mb'] = torch.cuda.memory_allocated() / 1024**2
+            print(f'Loaded {model_name_or_path} on {device}: {_hf_pipeline_stats[pipeline_key]}')
+            
+    return _hf_pipelines[pipeline_key]
+
+
+def release_hugging_face_pipeline(model_name_or_path = None, device = None):
+    # release one cached pipeline, or all of them when no model is given
+    with _hf_pipelines_lock:
+        for pipeline_key in list(_hf_pipelines.keys()):
+            if model_name_or_path is not None and pipeline_key[0] != model_name_or_path:
+                continue
+            if device is not None and pipeline_key[1] != device:
+                continue
+            del _hf_pipelines[pipeline_key]
+            _hf_pipeline_stats.pop(pipeline_key, None)
+            
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def get_hugging_face_pipeline_stats():
+    return {f'{model_name_or_path} ({device})': dict(stats) for (model_name_or_path, device), stats in _hf_pipeline_stats.items()}
+
+
 class hugging_face_models():
-    def __init__(self, model_name_or_path, temperature = 0, max_tokens=1024, device = 'cuda'):
+    def __init__(self, model_name_or_path, temperature = 0, max_tokens=1024, device = 'cuda', batch_size = 8):
         self.model_name_or_path = model_name_or_path
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.device = device
+        self.batch_size = batch_size
         
-        self.pipe = pipeline(
-            "text-generation",
-            model=self.model_name_or_path,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=self.device
-        )
+    @property
+    def pipe(self):
+        # loaded lazily on first use and shared through the process-wide cache
+        return load_hugging_face_pipeline(self.model_name_or_path, self.device)
         
     def generate_response(self, task_prompt):
         prompt_preamble="You are an oncologist. Answer based on the given clinical note for a patient."
         
+        # responses are sampled, so they are only cached if the cache allows sampled responses
+        cache = get_llm_response_cache(self.temperature, do_sample=True)
+        if cache is not None:
+            cache_key = cache.make_key(self.model_name_or_path, prompt_preamble, task_prompt, self.temperature)
+            response = cache.get(cache_key)
+            if response is not None:
+                return response
+        
         task_prompt = prompt_preamble + '\n' + task_prompt
         messages = [
             {"role": "user", "content": task_prompt},
@@ -99,5 +316,42 @@ class hugging_face_models():
         outputs = self.pipe(messages, max_new_tokens=self.max_tokens, temperature=self.temperature,do_sample=True)
         
         response = outputs[0]["generated_text"][-1]["content"].strip()
+        if cache is not None:
+            cache.set(cache_key, response)
+        
+        return response
+    
+    def generate_batch(self, task_prompts, batch_size = None):
+        # generate responses for many prompts with batched forward passes, returned in the input order
+        prompt_preamble="You are an oncologist. Answer based on the given clinical note for a patient."
+        if batch_size is None:
+            batch_size = self.batch_size
+        
+        responses = [None] * len(task_prompts)
+        cache = get_llm_response_cache(self.temperature, do_sample=True)
+        if cache is not None:
+            cache_keys = [cache.make_key(self.model_name_or_path, prompt_preamble, task_prompt, self.temperature) for task_prompt in task_prompts]
+            responses = [cache.get(cache_key) for cache_key in cache_keys]
+        # only the prompts without a cached response go through the model
+        pending = [i for i in range(len(task_prompts)) if responses[i] is None]
+        if len(pending) == 0:
+            return responses
+        
+        pipe = self.pipe
+        # decoder-only models need a pad token and left padding to batch prompts of different lengths
+        if pipe.tokenizer.pad_token_id is None:
+            pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+        pipe.tokenizer.padding_side = 'left'
+        
+        # sort by length so that prompts in a batch need little padding
+        order = sorted(pending, key=lambda i: len(task_prompts[i]))
+        messages_list = [[{"role": "user", "content": prompt_preamble + '\n' + task_prompts[i]}] for i in order]
+        
+        outputs = pipe(messages_list, max_new_tokens=self.max_tokens, temperature=self.temperature,do_sample=True, batch_size=batch_size)
+        
+        for i, output in zip(order, outputs):
+            responses[i] = output[0]["generated_text"][-1]["content"].strip()
+            if cache is not None:
+                cache.set(cache_keys[i], responses[i])
         
-        return response
\ No newline at end of file
+        return responses
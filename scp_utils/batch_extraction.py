@@ -0,0 +1,135 @@
+import os
+import json
+import time
+
+from openai.lib._parsing._completions import type_to_response_format_param
+
+from scp_utils.kb_extraction import call_with_retry
+
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_STATE_FILE = 'batch_state.json'
+BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchExtraction():
+    '''
+    Extraction requests sent through the OpenAI Batch API instead of one synchronous request per chunk.
+    Requests are written to JSONL files in batch_dir as they are added (the page images are not kept in memory),
+    submitted as batches of at most max_requests_per_batch requests / max_batch_file_mb, and polled until they finish.
+    The submitted batches are recorded in batch_state.json, so an interrupted run collects them instead of submitting again.
+    Every response is appended to the checkpoint of its PDF (see ExtractionCheckpoint).
+    '''
+    def __init__(self, client, batch_dir, response_format, model='gpt-4o-2024-08-06', temperature=0.2,
+                 poll_interval_s=60, max_requests_per_batch=50000, max_batch_file_mb=190):
+        self.client = client
+        self.batch_dir = batch_dir
+        self.response_format = type_to_response_format_param(response_format)
+        self.model = model
+        self.temperature = temperature
+        self.poll_interval_s = poll_interval_s
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_batch_file_bytes = max_batch_file_mb * 1024 * 1024
+        os.makedirs(batch_dir, exist_ok=True)
+
+        self.state_path = os.path.join(batch_dir, BATCH_STATE_FILE)
+        self.batches = [] # submitted batches, {'id', 'requests': {custom_id: request info}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.batches = json.load(f)['batches']
+        # requests of the batch file that is being written
+        self.batch_file = None
+        self.batch_file_bytes = 0
+        self.batch_requests = {}
+        self.pending_files = [] # (file path, requests) of the written batch files
+        self.num_requests = 0
+
+    def has_submitted_batches(self):
+        return len(self.batches) > 0
+
+    def add(self, messages, pdf_file_name, pdf_hash, page_number, chunk_hash):
+        # custom ids are unique across the batches of a run and map back to the chunk of a PDF
+        request = json.dumps({'custom_id': f'request-{self.num_requests}',
+                              'method': 'POST',
+                              'url': BATCH_ENDPOINT,
+                              'body': {'model': self.model,
+                                       'temperature': self.temperature,
+                                       'response_format': self.response_format,
+                                       'messages': messages}}) + '\n'
+        if self.batch_file is not None and (len(self.batch_requests) >= self.max_requests_per_batch or
+                                            self.batch_file_bytes + len(request) > self.max_batch_file_bytes):
+            self._close_batch_file()
+        if self.batch_file is None:
+            path = os.path.join(self.batch_dir, f'batch_input_{int(time.time())}_{len(self.pending_files)}.jsonl')
+            self.batch_file = open(path, 'w')
+        self.batch_file.write(request)
+        self.batch_file_bytes += len(request)
+        self.batch_requests[f'request-{self.num_requests}'] = {'pdf_file_name': pdf_file_name, 'pdf_hash': pdf_hash,
+                                                               'page_number': page_number, 'chunk_hash': chunk_hash}
+        self.num_requests += 1
+
+    def _close_batch_file(self):
+        self.batch_file.close()
+        self.pending_files.append((self.batch_file.name, self.batch_requests))
+        self.batch_file = None
+        self.batch_file_bytes = 0
+        self.batch_requests = {}
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'batches': self.batches}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def submit(self):
+        if self.batch_file is not None:
+            self._close_batch_file()
+        for path, requests in self.pending_files:
+            with open(path, 'rb') as f:
+                file_content = f.read()
+            input_file = call_with_retry(lambda: self.client.files.create(file=(os.path.basename(path), file_content), purpose='batch'))
+            batch = call_with_retry(lambda: self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                                                      completion_window='24h'))
+            print(f'Submitted batch {batch.id} with {len(requests)} extraction requests')
+            self.batches.append({'id': batch.id, 'requests': requests})
+            self._save_state()
+            os.remove(path)
+        self.pending_files = []
+
+    def _read_output(self, file_id):
+        # custom_id -> message content of the successful requests in a batch output file
+        contents = {}
+        for line in call_with_retry(lambda: self.client.files.content(file_id)).text.splitlines():
+            if len(line.strip()) == 0:
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') is None and response.get('status_code') == 200:
+                content = response['body']['choices'][0]['message']['content']
+                # refusals have no content and are left out like failed requests
+                if content is not None:
+                    contents[result['custom_id']] = content
+        return contents
+
+    def wait(self, get_checkpoint):
+        '''
+        Poll the submitted batches until they finish and append their responses to the checkpoints,
+        get_checkpoint(pdf_file_name) returns the ExtractionCheckpoint of a PDF.
+        Requests that failed or were refused are left out, so the next run sends them again.
+        '''
+        while len(self.batches) > 0:
+            for batch_info in list(self.batches):
+                batch = call_with_retry(lambda: self.client.batches.retrieve(batch_info['id']))
+                if batch.status not in BATCH_FINAL_STATUSES:
+                    continue
+                contents = self._read_output(batch.output_file_id) if batch.output_file_id is not None else {}
+                for custom_id, content in contents.items():
+                    request = batch_info['requests'][custom_id]
+                    get_checkpoint(request['pdf_file_name']).append(request['pdf_hash'], request['page_number'], request['chunk_hash'], content)
+                num_failed = len(batch_info['requests']) - len(contents)
+                print(f'Batch {batch.id} {batch.status}: {len(contents)} responses, {num_failed} failed')
+                self.batches.remove(batch_info)
+                self._save_state()
+            if len(self.batches) > 0:
+                print(f'Waiting for {len(self.batches)} batches...')
+                time.sleep(self.poll_interval_s)
@@ -0,0 +1,169 @@
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+import email.parser
+import email.policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def echo_extraction_responder(body):
+    # one extracted rule per request, quoting the start of the chunk text, in the StructuredOutput format of create_kb.py
+    content = body['messages'][-1]['content']
+    text = content if isinstance(content, str) else ' '.join(part.get('text', '') for part in content if part['type'] == 'text')
+    text = text.split('**Text:**')[-1].strip(' -\n')[:200]
+    return json.dumps({'extracted_information': [{'information_category': 'Additional Information',
+                                                  'info': text,
+                                                  'keywords': text.split()[:2],
+                                                  'source': text}]})
+
+
+class BatchStubServer():
+    '''
+    Local stand-in for the OpenAI files and batches endpoints used by BatchExtraction, to run the batch mode of
+    create_kb.py without an OpenAI account, e.g. with OpenAI(api_key='stub', base_url=server.base_url).
+    A batch is reported as in_progress for the first polls_until_complete retrievals and then completed, and each
+    request is answered with responder(request body), which returns the message content.
+    Requests whose custom id is in fail_custom_ids are returned as failed.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, responder=echo_extraction_responder, polls_until_complete=1, fail_custom_ids=()):
+        self.responder = responder
+        self.polls_until_complete = polls_until_complete
+        self.fail_custom_ids = set(fail_custom_ids)
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.RLock() # a batch is run while its retrieval holds the lock
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _add_file(self, filename, content, purpose):
+        file_object = {'id': f'file-{uuid.uuid4().hex}', 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                       'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_object['id']] = (file_object, content)
+        return file_object
+
+    def _run_batch(self, batch):
+        # answers every request of the input file and stores the output and error files
+        outputs, errors = [], []
+        for line in self.files[batch['input_file_id']][1].decode('utf-8').splitlines():
+            if len(line.strip()) == 0:
+                continue
+            request = json.loads(line)
+            if request['custom_id'] in self.fail_custom_ids:
+                errors.append({'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'server_error', 'message': 'Request failed in the stub server.'}})
+                continue
+            completion = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()),
+                          'model': request['body']['model'],
+                          'choices': [{'index': 0, 'finish_reason': 'stop',
+                                       'message': {'role': 'assistant', 'content': self.responder(request['body'])}}]}
+            outputs.append({'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': request['custom_id'],
+                            'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': completion}, 'error': None})
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+        batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs), 'failed': len(errors)}
+        batch['output_file_id'] = self._add_file('batch_output.jsonl', ''.join(json.dumps(x) + '\n' for x in outputs).encode('utf-8'), 'batch_output')['id']
+        if len(errors) > 0:
+            batch['error_file_id'] = self._add_file('batch_errors.jsonl', ''.join(json.dumps(x) + '\n' for x in errors).encode('utf-8'), 'batch_output')['id']
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, content_type='application/json'):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _not_found(self):
+                self._send(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+            def _read_body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def do_POST(self):
+                body = self._read_body()
+                if self.path == '/v1/files':
+                    # multipart upload with the purpose and file fields
+                    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8') + body)
+                    fields = {part.get_param('name', header='content-disposition'): part for part in message.iter_parts()}
+                    file_part = fields['file']
+                    self._send(200, server._add_file(file_part.get_filename(), file_part.get_payload(decode=True),
+                                                     fields['purpose'].get_content().strip()))
+                elif self.path == '/v1/batches':
+                    request = json.loads(body)
+                    if request['input_file_id'] not in server.files:
+                        self._send(400, {'error': {'message': 'Unknown input file.', 'type': 'invalid_request_error'}})
+                        return
+                    batch = {'id': f'batch_{uuid.uuid4().hex}', 'object': 'batch', 'endpoint': request['endpoint'],
+                             'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+                             'status': 'validating', 'created_at': int(time.time()), 'output_file_id': None, 'error_file_id': None,
+                             'metadata': request.get('metadata'), 'polls': 0}
+                    with server.lock:
+                        server.batches[batch['id']] = batch
+                    self._send(200, {k: v for k, v in batch.items() if k != 'polls'})
+                else:
+                    match = re.fullmatch(r'/v1/batches/([\w-]+)/cancel', self.path)
+                    if match is None or match.group(1) not in server.batches:
+                        self._not_found()
+                        return
+                    with server.lock:
+                        batch = server.batches[match.group(1)]
+                        if batch['status'] not in ('completed', 'failed', 'expired'):
+                            batch['status'] = 'cancelled'
+                            batch['cancelled_at'] = int(time.time())
+                    self._send(200, {k: v for k, v in batch.items() if k != 'polls'})
+
+            def do_GET(self):
+                match = re.fullmatch(r'/v1/files/([\w-]+)/content', self.path)
+                if match is not None and match.group(1) in server.files:
+                    self._send(200, server.files[match.group(1)][1], content_type='application/octet-stream')
+                    return
+                match = re.fullmatch(r'/v1/batches/([\w-]+)', self.path)
+                if match is not None and match.group(1) in server.batches:
+                    with server.lock:
+                        batch = server.batches[match.group(1)]
+                        if batch['status'] in ('validating', 'in_progress'):
+                            batch['polls'] += 1
+                            batch['status'] = 'in_progress'
+                            if batch['polls'] > server.polls_until_complete:
+                                server._run_batch(batch)
+                    self._send(200, {k: v for k, v in batch.items() if k != 'polls'})
+                    return
+                self._not_found()
+
+        return Handler
+
+
+if __name__ == '__main__':
+    # serve the stub on a fixed port and point create_kb.py at it with OPENAI_BASE_URL, e.g.
+    # python -m scp_utils.batch_stub_server 8765
+    # OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python create_kb.py
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = BatchStubServer(port=port)
+    print(f'Batch stub server listening on {server.base_url}')
+    server.httpd.serve_forever()
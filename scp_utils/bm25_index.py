@@ -0,0 +1,109 @@
+import os
+import re
+import json
+import numpy as np
+
+
+BM25_INDEX_FILE = 'bm25_index.npz'
+BM25_VOCAB_FILE = 'bm25_vocab.json'
+
+STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is', 'it', 'its', 'of', 'on',
+             'or', 'that', 'the', 'their', 'this', 'to', 'was', 'were', 'which', 'with', 'should', 'may', 'can', 'been'}
+
+
+def tokenize(text):
+    # lower-cased words, numbers and hyphenated terms such as '19-9' or '5-fu' are kept as single tokens
+    return [token for token in re.findall(r'[a-z0-9]+(?:[-.][a-z0-9]+)*', str(text).lower()) if token not in STOPWORDS]
+
+
+class BM25Index():
+    '''
+    Inverted BM25 index over the nodes of a KB.
+    Rows are in the order of the KB embedding matrix, so the category row ranges of a unified KB apply to it as well.
+    The postings are stored term-major (term_ptr, doc_rows, term_freqs) so a query only touches the postings of its terms.
+    '''
+    def __init__(self, ids, vocab, term_ptr, doc_rows, term_freqs, doc_lengths, k1=1.5, b=0.75):
+        self.ids = ids
+        self.vocab = vocab
+        self.term_ptr = term_ptr
+        self.doc_rows = doc_rows
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = max(float(np.mean(doc_lengths)) if len(doc_lengths) > 0 else 0.0, 1e-6)
+        document_freqs = np.diff(term_ptr)
+        self.idf = np.log(1 + (len(ids) - document_freqs + 0.5) / (document_freqs + 0.5)).astype(np.float32)
+
+    @classmethod
+    def build(cls, ids, texts, k1=1.5, b=0.75):
+        vocab = {}
+        postings = []
+        doc_lengths = np.zeros(len(ids), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[row] = len(tokens)
+            term_counts = {}
+            for token in tokens:
+                term_counts[token] = term_counts.get(token, 0) + 1
+            for token, count in term_counts.items():
+                postings.append((vocab.setdefault(token, len(vocab)), row, count))
+
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        postings = postings[np.lexsort((postings[:, 1], postings[:, 0]))]
+        term_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.add.at(term_ptr, postings[:, 0] + 1, 1)
+        term_ptr = np.cumsum(term_ptr)
+        return cls(list(ids), vocab, term_ptr, postings[:, 1].astype(np.int32), postings[:, 2].astype(np.float32), doc_lengths, k1=k1, b=b)
+
+    def save(self, index_path):
+        np.savez(os.path.join(index_path, BM25_INDEX_FILE), term_ptr=self.term_ptr, doc_rows=self.doc_rows,
+                 term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+        with open(os.path.join(index_path, BM25_VOCAB_FILE), 'w') as f:
+            json.dump({'ids': self.ids, 'vocab': self.vocab, 'k1': self.k1, 'b': self.b}, f)
+
+    @classmethod
+    def load(cls, index_path):
+        arrays = np.load(os.path.join(index_path, BM25_INDEX_FILE))
+        with open(os.path.join(index_path, BM25_VOCAB_FILE)) as f:
+            index_info = json.load(f)
+        return cls(index_info['ids'], index_info['vocab'], arrays['term_ptr'], arrays['doc_rows'], arrays['term_freqs'],
+                   arrays['doc_lengths'], k1=index_info['k1'], b=index_info['b'])
+
+    def score(self, query_str):
+        # BM25 score of every row for the query
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for token in set(tokenize(query_str)):
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_ptr[term_id], self.term_ptr[term_id + 1]
+            rows = self.doc_rows[start:end]
+            term_freqs = self.term_freqs[start:end]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[rows] / self.avg_doc_length)
+            scores[rows] += self.idf[term_id] * term_freqs * (self.k1 + 1) / (term_freqs + norm)
+        return scores
+
+    def search(self, query_str, top_k, start=0, end=None):
+        # top_k rows within [start, end) with a positive score, returns (node_ids, scores)
+        end = len(self.ids) if end is None else end
+        scores = self.score(query_str)[start:end]
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0:
+            return [], []
+        top_indices = candidates[np.argsort(-scores[candidates], kind='stable')[:top_k]]
+        return [self.ids[start + i] for i in top_indices], [float(scores[i]) for i in top_indices]
+
+
+def has_bm25_index(index_path):
+    return os.path.exists(os.path.join(index_path, BM25_INDEX_FILE)) and os.path.exists(os.path.join(index_path, BM25_VOCAB_FILE))
+
+
+def reciprocal_rank_fusion(ranked_lists, top_k, rrf_k=60):
+    # fuse ranked lists of node ids, each id scores sum(1 / (rrf_k + rank)) over the lists it appears in
+    fused_scores = {}
+    for ranked_ids in ranked_lists:
+        for rank, node_id in enumerate(ranked_ids):
+            fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    fused = sorted(fused_scores.items(), key=lambda x: -x[1])[:top_k]
+    return [node_id for node_id, _ in fused], [score for _, score in fused]
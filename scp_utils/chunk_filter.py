@@ -0,0 +1,132 @@
+import re
+import hashlib
+
+
+WORD_PATTERN = re.compile(r'[A-Za-z]{2,}')
+# a reference list entry: numbered or bracketed, with authors, et al., a year, a DOI/PMID or a journal volume(issue):pages
+CITATION_PATTERN = re.compile(r'^\s*(\[?\d{1,3}[\].)]\s+)?.*('
+                              r'\bet al\b|\bdoi\b|\bpmid\b|https?://doi|'
+                              r'\b(19|20)\d{2}\s*[;.]\s*\d+|\d+\s*\(\d+\)\s*:\s*\d+|'
+                              r'(?-i:^[A-Z][a-z]+ [A-Z]{1,2}(, [A-Z][a-z]+ [A-Z]{1,2})+))', re.IGNORECASE)
+AFFILIATION_PATTERN = re.compile(r'\b(department|university|hospital|institute|school of medicine|medical center|cancer center|'
+                                 r'faculty|affiliation|corresponding author|e-?mail|@[\w-]+\.\w+|received for publication|accepted for publication|'
+                                 r'conflicts? of interest|disclosures?|funding|acknowledg(e)?ments?|copyright|all rights reserved)\b', re.IGNORECASE)
+# markers of front/back matter, affiliation lines only count as boilerplate in their context
+FRONT_BACK_MATTER_PATTERN = re.compile(r'\b(corresponding author|received for publication|accepted for publication|conflicts? of interest|'
+                                       r'all rights reserved)\b', re.IGNORECASE)
+# an author affiliation line: optionally numbered (1Department of ..., * Division of ...), a department-level unit, then institution and city
+AUTHOR_AFFILIATION_PATTERN = re.compile(r'^\s*[\d¹²³⁴⁵⁶⁷⁸⁹⁰*†‡§]*\s*(department|division|school|faculty|laboratory|section|unit)\s+(of|for)\b[^,\n]*,[^,\n]*,',
+                                        re.IGNORECASE)
+SECTION_HEADINGS = re.compile(r'^\s*(references|bibliography|author affiliations|affiliations|acknowledg(e)?ments|disclosures)\s*$', re.IGNORECASE | re.MULTILINE)
+
+
+def remove_running_lines(page_texts, min_fraction=0.5, min_pages=3):
+    '''
+    Remove running headers and footers, lines (ignoring digits, e.g. page numbers) that repeat on at least
+    min_fraction of the pages of a PDF.
+    '''
+    if len(page_texts) < min_pages:
+        return page_texts
+    normalize = lambda line: re.sub(r'\d+', '#', line.strip().lower())
+    line_counts = {}
+    for text in page_texts:
+        for line in set(normalize(line) for line in text.splitlines() if line.strip()):
+            line_counts[line] = line_counts.get(line, 0) + 1
+    running_lines = {line for line, count in line_counts.items() if count >= min_fraction * len(page_texts)}
+    return ['\n'.join(line for line in text.splitlines() if normalize(line) not in running_lines) for text in page_texts]
+
+
+def simhash(text, num_bits=64):
+    # 64 bit SimHash over word 3-shingles, near-duplicate texts differ in only a few bits
+    words = [word.lower() for word in WORD_PATTERN.findall(text)]
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    weights = [0] * num_bits
+    for shingle in shingles:
+        shingle_hash = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=num_bits // 8).digest(), 'big')
+        for bit in range(num_bits):
+            weights[bit] += 1 if shingle_hash >> bit & 1 else -1
+    return sum(1 << bit for bit in range(num_bits) if weights[bit] > 0)
+
+
+class ChunkPrefilter():
+    '''
+    Cheap filter of the text chunks before LLM extraction. A chunk is dropped if it is
+      - 'empty': fewer than min_words words, i.e. only whitespace, punctuation, numbers or a page label,
+        short guideline rows such as 'Vitamin D 800 - 1,000 IU/day' are kept,
+      - 'references': mostly reference list entries,
+      - 'affiliations': mostly author affiliations, disclosures and other front/back matter. Lines naming institutions or
+        e-mail addresses only count under an affiliations/disclosures heading or a front/back matter marker (corresponding author,
+        received for publication, ...), elsewhere only author affiliation lines (Department of ..., institution, city) count,
+        so lists of survivorship programs and contacts are kept,
+      - 'duplicate': a near-duplicate (SimHash within max_hamming_distance bits) of a chunk seen before in the corpus.
+    The SimHash is split into max_hamming_distance + 1 blocks, two hashes within the distance share at least one block,
+    so only the chunks sharing a block are compared.
+    '''
+    def __init__(self, min_words=2, line_fraction=0.5, max_hamming_distance=3, num_bits=64):
+        self.min_words = min_words
+        self.line_fraction = line_fraction
+        self.max_hamming_distance = max_hamming_distance
+        self.num_bits = num_bits
+        self.num_blocks = max_hamming_distance + 1
+        self.block_bits = num_bits // self.num_blocks
+        self.blocks = [{} for _ in range(self.num_blocks)]
+        self.counts = {'kept': 0, 'empty': 0, 'references': 0, 'affiliations': 0, 'duplicate': 0}
+        self.dropped_tokens = 0
+
+    def _block_keys(self, text_hash):
+        mask = (1 << self.block_bits) - 1
+        return [text_hash >> (i * self.block_bits) & mask for i in range(self.num_blocks)]
+
+    def is_duplicate(self, text_hash):
+        for block, key in zip(self.blocks, self._block_keys(text_hash)):
+            for other_hash in block.get(key, []):
+                if bin(text_hash ^ other_hash).count('1') <= self.max_hamming_distance:
+                    return True
+        return False
+
+    def _insert(self, text_hash):
+        for block, key in zip(self.blocks, self._block_keys(text_hash)):
+            block.setdefault(key, []).append(text_hash)
+
+    def add(self, text):
+        # register a chunk as seen, e.g. the chunks of PDFs that were extracted in an earlier run
+        text_hash = simhash(text, self.num_bits)
+        if not self.is_duplicate(text_hash):
+            self._insert(text_hash)
+
+    def _line_fraction(self, lines, pattern):
+        return sum(1 for line in lines if pattern.search(line)) / max(len(lines), 1)
+
+    def check(self, text):
+        # reason for dropping the chunk, or None if it should be extracted
+        if len(WORD_PATTERN.findall(text)) < self.min_words:
+            return 'empty'
+        lines = [line for line in text.splitlines() if len(line.strip()) > 0]
+        heading = SECTION_HEADINGS.search(text)
+        if self._line_fraction(lines, CITATION_PATTERN) >= self.line_fraction or \
+                (heading is not None and heading.group(1).lower() in ('references', 'bibliography') and self._line_fraction(lines, CITATION_PATTERN) >= self.line_fraction / 2):
+            return 'references'
+        affiliation_context = (heading is not None and heading.group(1).lower() not in ('references', 'bibliography')) or \
+            FRONT_BACK_MATTER_PATTERN.search(text) is not None
+        if self._line_fraction(lines, AFFILIATION_PATTERN if affiliation_context else AUTHOR_AFFILIATION_PATTERN) >= self.line_fraction:
+            return 'affiliations'
+        text_hash = simhash(text, self.num_bits)
+        if self.is_duplicate(text_hash):
+            return 'duplicate'
+        self._insert(text_hash)
+        return None
+
+    def filter(self, text):
+        # True if the chunk should be sent for extraction, and count the outcome
+        reason = self.check(text)
+        self.counts['kept' if reason is None else reason] += 1
+        if reason is not None:
+            self.dropped_tokens += len(text) // 4
+        return reason is None
+
+    def report(self):
+        total = sum(self.counts.values())
+        dropped = total - self.counts['kept']
+        print(f'Prefilter kept {self.counts["kept"]} of {total} chunks, dropped {dropped} '
+              f'(empty: {self.counts["empty"]}, references: {self.counts["references"]}, '
+              f'affiliations: {self.counts["affiliations"]}, duplicates: {self.counts["duplicate"]}), ~{self.dropped_tokens} chunk tokens not sent')
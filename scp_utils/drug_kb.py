@@ -0,0 +1,100 @@
+import os
+import re
+import json
+
+
+def normalize_drug_name(name):
+    # lower case and drop everything but letters and digits, e.g. '5-FU' -> '5fu', 'Ado-Trastuzumab Emtansine' -> 'adotrastuzumabemtansine'
+    return re.sub(r'[^a-z0-9]', '', str(name).lower())
+
+
+class DrugKB():
+    '''
+    In-memory drug knowledge base.
+    All drug records are loaded once, either from the folder of <drug>.json files or from a single
+    consolidated JSON file, and indexed by normalized drug name, generic name and brand name so that
+    obvious agent strings are resolved without the neural matcher.
+    '''
+    def __init__(self, drug_info_kb_path):
+        self.drug_info_kb_path = drug_info_kb_path
+
+        if os.path.isdir(drug_info_kb_path):
+            self.records = {}
+            for drug_file in os.listdir(drug_info_kb_path):
+                with open(os.path.join(drug_info_kb_path, drug_file)) as f:
+                    self.records[drug_file.split('.json')[0]] = json.load(f)
+        else:
+            with open(drug_info_kb_path) as f:
+                self.records = json.load(f)
+
+        self.drug_names_list = list(self.records.keys())
+        self._build_lexical_index()
+
+    def _build_lexical_index(self):
+        # exact drug names take precedence over generic names, which take precedence over brand names
+        name_index, generic_index, brand_index = {}, {}, {}
+        for drug_name in sorted(self.drug_names_list):
+            record = self.records[drug_name]
+            name_index.setdefault(normalize_drug_name(drug_name), drug_name)
+            name_index.setdefault(normalize_drug_name(record.get('drug_name', drug_name)), drug_name)
+
+            description = record.get('description', '').strip()
+            # descriptions start with the generic name(s) in upper case, e.g. 'FLUOROURACIL (flure oh YOOR a sil) treats ...'
+            generic_match = re.match(r'([A-Z0-9][A-Z0-9 ,;\-]+?)\s*\(', description)
+            if generic_match:
+                generic_key = normalize_drug_name(generic_match.group(1))
+                # prefer the record that is named after the generic drug
+                if generic_key == normalize_drug_name(drug_name) or generic_key not in generic_index:
+                    generic_index[generic_key] = drug_name
+
+            brand_match = re.search(r'COMMON BRAND NAME\(S\):\s*(.*)', description)
+            if brand_match:
+                for brand_name in brand_match.group(1).split(','):
+                    brand_key = normalize_drug_name(brand_name)
+                    if brand_key == '':
+                        continue
+                    if brand_key == normalize_drug_name(drug_name) or brand_key not in brand_index:
+                        brand_index[brand_key] = drug_name
+
+        self.name_index = name_index
+        self.generic_index = generic_index
+        self.brand_index = brand_index
+
+    def lookup(self, agent):
+        # exact/normalized name, generic and brand name lookup, returns None if the agent is not an obvious match
+        candidates = [agent]
+        # also try both parts of strings like 'Taxol (paclitaxel)'
+        parenthetical = re.match(r'\s*(.+?)\s*\((.+?)\)\s*$', str(agent))
+        if parenthetical:
+            candidates += [parenthetical.group(1), parenthetical.group(2)]
+
+        for index in [self.name_index, self.generic_index, self.brand_index]:
+            for candidate in candidates:
+                drug_name = index.get(normalize_drug_name(candidate))
+                if drug_name is not None:
+                    return drug_name
+        return None
+
+    def get(self, drug_name):
+        return self.records[drug_name]
+
+    def get_drug_info(self, drug_name):
+        # drug information text added to the SCP prompts
+        drug_data = self.records[drug_name]
+        drug_info = f'\nDrug: {drug_name}\n'
+        drug_info += 'Description: '+ drug_data["description"]
+        drug_info += 'Side Effects: ' +drug_data['side_effects']
+        drug_info += 'What to monitor during intake: '+ drug_data['monitoring'] + '\n'
+        return drug_info
+
+    def save_consolidated(self, consolidated_path):
+        # write all records to a single JSON file that can be loaded instead of the folder
+        with open(consolidated_path, 'w') as f:
+            json.dump(self.records, f)
+
+
+if __name__ == '__main__':
+    drug_kb = DrugKB('./kbs/chemodrugs')
+    print(f'Number of drugs: {len(drug_kb.drug_names_list)}, generic names: {len(drug_kb.generic_index)}, brand names: {len(drug_kb.brand_index)}')
+    for agent in ['5-FU', 'Letrozole', 'letrozole', 'Taxol (paclitaxel)', 'Herceptin', 'Keytruda', 'AC-T']:
+        print(f'{agent} -> {drug_kb.lookup(agent)}')
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+
+class DrugNameIndex():
+    '''
+    Embedding index over the drug names of the drug knowledge base.
+    The names are embedded once with a bi-encoder and persisted in index_path; at query time the
+    top_k most similar names form a shortlist that the cross encoder reranks, instead of scoring
+    every drug name in the knowledge base.
+    '''
+    def __init__(self, drug_names_list, index_path, model_name='sentence-transformers/all-MiniLM-L6-v2', device='cuda'):
+        self.drug_names_list = list(drug_names_list)
+        self.index_path = index_path
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device=device)
+
+        embeddings_file = os.path.join(index_path, 'drug_name_embeddings.npy')
+        index_info_file = os.path.join(index_path, 'drug_name_index.json')
+        # the stored embeddings are reused only if they were built from the same names with the same model
+        names_hash = hashlib.sha256(('\n'.join(self.drug_names_list) + '\n' + model_name).encode('utf-8')).hexdigest()
+
+        index_info = {}
+        if os.path.exists(index_info_file) and os.path.exists(embeddings_file):
+            with open(index_info_file) as f:
+                index_info = json.load(f)
+
+        if index_info.get('names_hash') == names_hash:
+            self.embeddings = np.load(embeddings_file)
+        else:
+            print(f'Building drug name index for {len(self.drug_names_list)} drugs...')
+            self.embeddings = self.model.encode(self.drug_names_list, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+            if not os.path.exists(index_path):
+                os.makedirs(index_path)
+            np.save(embeddings_file, self.embeddings)
+            with open(index_info_file, 'w') as f:
+                json.dump({'model_name': model_name, 'names_hash': names_hash, 'drug_names': self.drug_names_list}, f)
+
+    def shortlist(self, agents, top_k=20):
+        # top_k most similar drug names for each agent, most similar first
+        agents = list(agents)
+        if len(agents) == 0:
+            return []
+        top_k = min(top_k, len(self.drug_names_list))
+        agent_embeddings = self.model.encode(agents, normalize_embeddings=True, convert_to_numpy=True)
+        scores = agent_embeddings @ self.embeddings.T
+
+        shortlists = []
+        for agent_scores in scores:
+            top_indices = np.argpartition(-agent_scores, top_k - 1)[:top_k]
+            top_indices = top_indices[np.argsort(-agent_scores[top_indices])]
+            shortlists.append([self.drug_names_list[i] for i in top_indices])
+        return shortlists
+
+    def match(self, agents, cross_encoder, top_k=20):
+        # rerank the shortlist of every agent with the cross encoder in a single batch and keep the best drug
+        agents = list(agents)
+        shortlists = self.shortlist(agents, top_k=top_k)
+        cross_encoder_input = [[agent, drug_name] for agent, shortlist in zip(agents, shortlists) for drug_name in shortlist]
+        if len(cross_encoder_input) == 0:
+            return {}
+        scores = cross_encoder.predict(cross_encoder_input)
+
+        drug_matches = {}
+        offset = 0
+        for agent, shortlist in zip(agents, shortlists):
+            agent_scores = scores[offset:offset + len(shortlist)]
+            drug_matches[agent] = shortlist[int(np.argmax(agent_scores))]
+            offset += len(shortlist)
+        return drug_matches
+
+
+def get_drug_name_index_path(drug_info_kb_path):
+    # stored next to (not inside) the drug knowledge base folder, which must only contain drug records
+    return os.path.splitext(os.path.normpath(drug_info_kb_path))[0] + '_name_index'
+
+
+def benchmark_drug_name_index(drug_name_index, cross_encoder, agents, top_k=20):
+    '''
+    Compare the shortlist + rerank matches against the cross encoder argmax over all drug names.
+    '''
+    start_time = time.perf_counter()
+    full_matches = {}
+    for agent in agents:
+        scores = cross_encoder.predict([[agent, drug_name] for drug_name in drug_name_index.drug_names_list])
+        full_matches[agent] = drug_name_index.drug_names_list[int(np.argmax(scores))]
+    full_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    index_matches = drug_name_index.match(agents, cross_encoder, top_k=top_k)
+    index_time = time.perf_counter() - start_time
+
+    mismatches = {agent: {'full': full_matches[agent], 'index': index_matches[agent]} for agent in agents if full_matches[agent] != index_matches[agent]}
+    return {'num_agents': len(agents),
+            'agreement': 1 - len(mismatches) / max(len(agents), 1),
+            'full_scoring_time_s': full_time,
+            'index_time_s': index_time,
+            'mismatches': mismatches}
+
+
+if __name__ == '__main__':
+    # benchmark the drug name index against scoring every drug name, from the repo root:
+    # python -m scp_utils.drug_matching
+    from sentence_transformers import CrossEncoder
+    from scp_utils.drug_kb import DrugKB
+
+    drug_info_kb_path = './kbs/chemodrugs'
+    device = 'cuda'
+    # agent strings as they typically appear in the extracted treatment summaries
+    benchmark_agents = ['Doxorubicin', 'Adriamycin', 'cyclophosphamide', 'Paclitaxel', 'Taxol (paclitaxel)', 'Carboplatin',
+                        'Cisplatin', 'Etoposide', '5-FU', 'Fluorouracil', 'Capecitabine', 'Oxaliplatin', 'Letrozole',
+                        'Anastrozole', 'Tamoxifen', 'Trastuzumab', 'Herceptin', 'Pertuzumab', 'Pembrolizumab', 'Keytruda',
+                        'Nivolumab', 'Bevacizumab', 'Rituximab', 'Gemcitabine', 'Docetaxel', 'Irinotecan', 'Leuprolide',
+                        'Abiraterone', 'Imatinib', 'Osimertinib', 'Zoledronic acid', 'Methotrexate', 'Vincristine',
+                        'Prednisone', 'Temozolomide']
+
+    drug_kb = DrugKB(drug_info_kb_path)
+    drug_name_index = DrugNameIndex(drug_kb.drug_names_list, get_drug_name_index_path(drug_info_kb_path), device=device)
+    cross_encoder = CrossEncoder(model_name='cross-encoder/ms-marco-MiniLM-L-12-v2', device=device)
+
+    for top_k in [10, 20, 50]:
+        results = benchmark_drug_name_index(drug_name_index, cross_encoder, benchmark_agents, top_k=top_k)
+        print(f"top_k={top_k}: agreement={results['agreement']:.3f}, full={results['full_scoring_time_s']:.2f}s, index={results['index_time_s']:.2f}s")
+        for agent, mismatch in results['mismatches'].items():
+            print(f'  {agent}: {mismatch}')
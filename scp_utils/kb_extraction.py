@@ -0,0 +1,272 @@
+import io
+import os
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import fitz
+import openai
+from PIL import Image
+
+
+class RateLimiter():
+    '''
+    Request- and token-per-minute limiter shared by the extraction workers.
+    Both budgets refill continuously, and acquire blocks until the request and its estimated tokens fit.
+    '''
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed_minutes * self.requests_per_minute)
+        self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed_minutes * self.tokens_per_minute)
+
+    def acquire(self, num_tokens=0):
+        # a single request larger than the token budget waits for a full budget instead of blocking forever
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.request_allowance >= 1 and self.token_allowance >= num_tokens:
+                    self.request_allowance -= 1
+                    self.token_allowance -= num_tokens
+                    return
+                wait_s = 60 * max((1 - self.request_allowance) / self.requests_per_minute,
+                                  (num_tokens - self.token_allowance) / self.tokens_per_minute)
+            time.sleep(max(wait_s, 0.01))
+
+
+def estimate_tokens(messages, max_output_tokens=1000):
+    # rough token count of a chat request, ~4 characters per token, a 300 dpi page image is scaled to 768 px (~765 tokens)
+    num_tokens = max_output_tokens
+    for message in messages:
+        contents = message['content'] if isinstance(message['content'], list) else [{'type': 'text', 'text': message['content']}]
+        for content in contents:
+            if content['type'] == 'text':
+                num_tokens += len(content['text']) // 4
+            else:
+                num_tokens += 765
+    return num_tokens
+
+
+def is_retryable_error(error):
+    # rate limits, server errors and dropped connections are retried, other client errors are not
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def call_with_retry(fn, max_retries=6, base_delay_s=1.0, max_delay_s=60.0):
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            # exponential backoff with jitter, or the delay requested by the server
+            delay_s = min(max_delay_s, base_delay_s * 2 ** attempt) * (0.5 + random.random())
+            response = getattr(e, 'response', None)
+            if response is not None and response.headers.get('retry-after') is not None:
+                try:
+                    delay_s = max(delay_s, float(response.headers.get('retry-after')))
+                except ValueError:
+                    pass
+            print(f'Retrying after {type(e).__name__} in {delay_s:.1f}s (attempt {attempt + 1}/{max_retries})')
+            time.sleep(delay_s)
+
+
+class ExtractionRequestPool():
+    '''
+    Structured output extraction requests sent by max_workers threads as soon as they are submitted, e.g. the chunks or
+    page images of a PDF as they are produced. submit blocks while max_pending requests are queued or running, so only
+    the messages (page images) of those requests are held in memory.
+    on_response(content) is called as soon as a request succeeds, e.g. to checkpoint it.
+    Requests that still fail after max_retries or are refused by the model are printed and counted in num_failed.
+    '''
+    def __init__(self, client, response_format, model='gpt-4o-2024-08-06', temperature=0.2, rate_limiter=None,
+                 max_workers=8, max_retries=6, max_pending=None):
+        self.client = client
+        self.response_format = response_format
+        self.model = model
+        self.temperature = temperature
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending if max_pending is not None else 2 * max_workers)
+        self.lock = threading.Lock()
+        self.num_failed = 0
+
+    def _request(self, messages):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(estimate_tokens(messages))
+        completion = self.client.beta.chat.completions.parse(
+                        model=self.model,
+                        temperature=self.temperature,
+                        response_format=self.response_format,
+                        messages=messages)
+        return completion.choices[0].message.content
+
+    def _run(self, messages, on_response):
+        try:
+            content = call_with_retry(lambda: self._request(messages), max_retries=self.max_retries)
+            if content is None:
+                # a refusal has no content, it is not checkpointed so that the next run sends the request again
+                raise ValueError('The model returned no content (refusal)')
+            if on_response is not None:
+                on_response(content)
+        except Exception as e:
+            print(f'Extraction request failed: {e}')
+            with self.lock:
+                self.num_failed += 1
+        finally:
+            self.slots.release()
+
+    def submit(self, messages, on_response=None):
+        self.slots.acquire()
+        self.executor.submit(self._run, messages, on_response)
+
+    def close(self):
+        # wait for the submitted requests to finish
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# PDF opened once per render process by _open_render_pdf
+_render_pdf = None
+
+
+def _open_render_pdf(pdf_path):
+    global _render_pdf
+    _render_pdf = fitz.open(pdf_path)
+
+
+def _render_page(page_index, dpi=300, image_format='png', jpeg_quality=90):
+    pix = _render_pdf[page_index].get_pixmap(dpi=dpi)
+    if image_format == 'png':
+        return pix.tobytes('png')
+    image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=jpeg_quality)
+    return buffer.getvalue()
+
+
+def render_pdf_pages(pdf_path, dpi=300, image_format='png', jpeg_quality=90, num_workers=None, max_ahead=None):
+    '''
+    Render the pages of a PDF to in-memory PNG or JPEG bytes in a process pool.
+    Yields (page_index, image_bytes) in page order as the pages are rendered, no temporary files are written.
+    At most max_ahead (default 2 * num_workers) pages are rendered ahead of the consumer, so a consumer that is slower
+    than the rendering (e.g. waiting for extraction requests) does not accumulate the images of the whole PDF.
+    '''
+    if image_format not in ('png', 'jpeg'):
+        raise ValueError(f"Unknown image format {image_format}, expected 'png' or 'jpeg'.")
+    with fitz.open(pdf_path) as pdf_file:
+        num_pages = len(pdf_file)
+    num_workers = min(num_workers or os.cpu_count() or 1, max(num_pages, 1))
+    max_ahead = max_ahead if max_ahead is not None else 2 * num_workers
+    render_page = partial(_render_page, dpi=dpi, image_format=image_format, jpeg_quality=jpeg_quality)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_open_render_pdf, initargs=(pdf_path,)) as executor:
+        futures = deque()
+        next_page = 0
+        for page_index in range(num_pages):
+            while next_page < num_pages and len(futures) < max_ahead:
+                futures.append(executor.submit(render_page, next_page))
+                next_page += 1
+            yield page_index, futures.popleft().result()
+
+
+def image_data_url(image_bytes, image_format='png'):
+    return f"data:image/{image_format};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def request_hash(messages):
+    # hash of the full request (prompt and chunk text or page image), a chunk is re-extracted only if it changed
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ExtractionCheckpoint():
+    '''
+    Append-only log of the extraction responses of one PDF, one JSON line per (pdf hash, page, chunk hash).
+    Responses are looked up by chunk hash, so after a crash or a change of the PDF only new or changed chunks are sent again.
+    '''
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.responses = {}
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # partially written last line of an interrupted run
+                    self.responses[entry['chunk_hash']] = entry
+
+    def get(self, chunk_hash):
+        entry = self.responses.get(chunk_hash)
+        return None if entry is None else entry['response']
+
+    def append(self, pdf_hash, page_number, chunk_hash, response):
+        entry = {'pdf_hash': pdf_hash, 'page_number': page_number, 'chunk_hash': chunk_hash, 'response': response}
+        with self.lock:
+            self.responses[chunk_hash] = entry
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self, chunk_hashes):
+        # keep only the entries of the current chunks, e.g. once a changed PDF has been extracted
+        with self.lock:
+            self.responses = {chunk_hash: self.responses[chunk_hash] for chunk_hash in chunk_hashes if chunk_hash in self.responses}
+            tmp_path = self.log_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for entry in self.responses.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.log_path)
+
+
+def parse_extracted_rules(response_content, metadata, source=None):
+    '''
+    Rules of one extraction response, each with its own copy of the chunk metadata.
+    source is the chunk text for text chunks; for page images the source quoted by the model is used.
+    '''
+    rules = []
+    extract_info_dict = json.loads(response_content)
+    for extract_info in extract_info_dict['extracted_information']:
+        if "No information found" in extract_info['info']:
+            continue
+        rule = {}
+        rule['information_category'] = extract_info['information_category']
+        rule['info'] = extract_info['info']
+        rule['metadata'] = dict(metadata)
+        rule['metadata']['keywords'] = extract_info['keywords']
+        rule['source'] = source if source is not None else extract_info['source']
+        rules.append(rule)
+    return rules
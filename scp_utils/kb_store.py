@@ -0,0 +1,450 @@
+import os
+import sys
+import json
+import zlib
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, MetadataMode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+from scp_utils.bm25_index import BM25Index, has_bm25_index, reciprocal_rank_fusion
+from llama_index.core.vector_stores import SimpleVectorStore
+
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+EMBEDDING_IDS_FILE = 'embedding_ids.json'
+DOCSTORE_SQLITE_FILE = 'docstore.sqlite'
+UNIFIED_KB_FOLDER = 'unified'
+COLBERT_TOKENS_FILE = 'colbert_tokens.npy'
+COLBERT_TOKEN_INDEX_FILE = 'colbert_token_index.json'
+
+
+def export_kb_embeddings(KB_path, embed_model=None, dtype='float16', index=None):
+    '''
+    Store the node embeddings of a persisted KB as a row-normalized (float16/float32) matrix in embeddings.npy
+    and the node id of every row in embedding_ids.json, so that create_KB_retriever can memory-map them.
+    Embeddings are taken from the index or the persisted vector store; nodes without a stored embedding
+    (e.g. KBs persisted without a vector store) are embedded once with embed_model.
+    '''
+    if index is not None:
+        docstore = index.docstore
+        node_ids = list(index.index_struct.nodes_dict.keys())
+        embedding_dict = dict(index.vector_store.data.embedding_dict) if isinstance(index.vector_store, SimpleVectorStore) else {}
+    else:
+        docstore = SimpleDocumentStore.from_persist_dir(KB_path)
+        node_ids = list(docstore.docs.keys())
+        embedding_dict = {}
+        vector_store_path = os.path.join(KB_path, 'default__vector_store.json')
+        if os.path.exists(vector_store_path):
+            embedding_dict = dict(SimpleVectorStore.from_persist_path(vector_store_path).data.embedding_dict)
+
+    missing_ids = []
+    for node_id in node_ids:
+        if node_id not in embedding_dict:
+            node = docstore.get_node(node_id)
+            if node.embedding is not None:
+                embedding_dict[node_id] = node.embedding
+            else:
+                missing_ids.append(node_id)
+
+    if embed_model is None:
+        embed_model = Settings.embed_model
+    if len(missing_ids) > 0:
+        print(f'Embedding {len(missing_ids)} nodes without a stored embedding in {KB_path}...')
+        texts = [docstore.get_node(node_id).get_content(metadata_mode=MetadataMode.EMBED) for node_id in missing_ids]
+        for node_id, embedding in zip(missing_ids, embed_model.get_text_embedding_batch(texts, show_progress=True)):
+            embedding_dict[node_id] = embedding
+
+    embeddings = np.array([embedding_dict[node_id] for node_id in node_ids], dtype=np.float32)
+    # normalize the rows so that cosine similarity is a dot product at query time
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    np.save(os.path.join(KB_path, EMBEDDINGS_FILE), embeddings.astype(dtype))
+    with open(os.path.join(KB_path, EMBEDDING_IDS_FILE), 'w') as f:
+        # the embedding model is recorded since the KB must be queried with the same model
+        json.dump({'ids': node_ids, 'embed_model': embed_model.model_name}, f)
+
+
+def convert_docstore_to_sqlite(KB_path, docstore=None):
+    '''
+    Write the nodes of a persisted KB docstore to docstore.sqlite, one zlib-compressed JSON record per node id,
+    so that only the retrieved nodes are parsed at query time instead of the whole docstore.json.
+    '''
+    if docstore is None:
+        docstore = SimpleDocumentStore.from_persist_dir(KB_path)
+
+    _write_node_records(os.path.join(KB_path, DOCSTORE_SQLITE_FILE),
+                        ((node_id, zlib.compress(json.dumps(doc_to_json(node)).encode('utf-8'))) for node_id, node in docstore.docs.items()))
+
+
+def _write_node_records(db_path, node_records):
+    # node_records are (node_id, compressed node JSON) pairs
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE nodes (node_id TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+    conn.executemany('INSERT INTO nodes (node_id, data) VALUES (?, ?)', node_records)
+    conn.commit()
+    conn.close()
+    # replaced in one step so that a reader never sees a partially written store
+    os.replace(tmp_path, db_path)
+
+
+def _read_node_records(KB_path):
+    # (node_id, compressed node JSON) pairs of a KB, from docstore.sqlite if it exists, else from docstore.json
+    db_path = os.path.join(KB_path, DOCSTORE_SQLITE_FILE)
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        node_records = conn.execute('SELECT node_id, data FROM nodes').fetchall()
+        conn.close()
+        return node_records
+    docstore = SimpleDocumentStore.from_persist_dir(KB_path)
+    return [(node_id, zlib.compress(json.dumps(doc_to_json(node)).encode('utf-8'))) for node_id, node in docstore.docs.items()]
+
+
+def load_kb_nodes(KB_path):
+    # node ids and nodes of a KB, in the row order of its embedding matrix if it has been exported
+    if has_kb_embeddings(KB_path) and os.path.exists(os.path.join(KB_path, DOCSTORE_SQLITE_FILE)):
+        with open(os.path.join(KB_path, EMBEDDING_IDS_FILE)) as f:
+            node_ids = json.load(f)['ids']
+        return node_ids, SQLiteNodeStore(KB_path).get_nodes(node_ids)
+    docstore = SimpleDocumentStore.from_persist_dir(KB_path)
+    if has_kb_embeddings(KB_path):
+        with open(os.path.join(KB_path, EMBEDDING_IDS_FILE)) as f:
+            node_ids = json.load(f)['ids']
+    else:
+        node_ids = list(docstore.docs.keys())
+    return node_ids, [docstore.get_node(node_id) for node_id in node_ids]
+
+
+def export_bm25_index(KB_path):
+    '''
+    Build the BM25 index over the text and keywords of the KB nodes and store it with the KB.
+    '''
+    node_ids, nodes = load_kb_nodes(KB_path)
+    texts = [node.get_content() + ' ' + ' '.join(node.metadata.get('keywords', [])) for node in nodes]
+    BM25Index.build(node_ids, texts).save(KB_path)
+
+
+def save_colbert_tokens(KB_path, node_ids, token_embeddings, model_name, text_mode):
+    '''
+    Store the ColBERT token embeddings of the KB nodes as one float16 matrix of concatenated token rows
+    (colbert_tokens.npy) with the node ids and row offsets in colbert_token_index.json.
+    text_mode names the node text that was encoded (see scp_utils.rerankers.COLBERT_TEXT_MODE).
+    '''
+    offsets = np.cumsum([0] + [len(x) for x in token_embeddings])
+    np.save(os.path.join(KB_path, COLBERT_TOKENS_FILE), np.concatenate(token_embeddings, axis=0).astype(np.float16))
+    with open(os.path.join(KB_path, COLBERT_TOKEN_INDEX_FILE), 'w') as f:
+        json.dump({'model_name': model_name, 'text_mode': text_mode, 'ids': list(node_ids), 'offsets': offsets.tolist()}, f)
+
+
+def has_colbert_tokens(KB_path):
+    return os.path.exists(os.path.join(KB_path, COLBERT_TOKENS_FILE)) and os.path.exists(os.path.join(KB_path, COLBERT_TOKEN_INDEX_FILE))
+
+
+class ColbertTokenStore():
+    '''
+    Memory-mapped ColBERT token embeddings of the nodes of a KB.
+    '''
+    def __init__(self, KB_path):
+        self.KB_path = KB_path
+        self.tokens = np.load(os.path.join(KB_path, COLBERT_TOKENS_FILE), mmap_mode='r')
+        with open(os.path.join(KB_path, COLBERT_TOKEN_INDEX_FILE)) as f:
+            token_index = json.load(f)
+        self.model_name = token_index['model_name']
+        # None for the stores of earlier builds, which encoded the node text with its embed metadata
+        self.text_mode = token_index.get('text_mode')
+        offsets = token_index['offsets']
+        self.spans = {node_id: (offsets[i], offsets[i + 1]) for i, node_id in enumerate(token_index['ids'])}
+
+    def get(self, node_id):
+        # (num_tokens, dim) float16 view of the node's token embeddings, or None if the node is not stored
+        span = self.spans.get(node_id)
+        if span is None:
+            return None
+        return self.tokens[span[0]:span[1]]
+
+
+def get_unified_kb_path(scp_task_kb_path):
+    return os.path.join(scp_task_kb_path, UNIFIED_KB_FOLDER)
+
+
+def get_kb_fingerprint(KB_path):
+    # hash of the node ids and ColBERT token index of a KB, changes whenever the KB is rebuilt or updated
+    sha256 = hashlib.sha256()
+    for file_name in (EMBEDDING_IDS_FILE, COLBERT_TOKEN_INDEX_FILE):
+        path = os.path.join(KB_path, file_name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                sha256.update(file_name.encode('utf-8') + f.read())
+    return sha256.hexdigest()
+
+
+def is_unified_kb_current(scp_task_kb_path, categories, unified_kb_path=None):
+    # True if the unified KB was built from the current version of every category KB
+    if unified_kb_path is None:
+        unified_kb_path = get_unified_kb_path(scp_task_kb_path)
+    if not has_kb_embeddings(unified_kb_path):
+        return False
+    with open(os.path.join(unified_kb_path, EMBEDDING_IDS_FILE)) as f:
+        source_fingerprints = json.load(f).get('source_fingerprints')
+    return source_fingerprints == {category: get_kb_fingerprint(os.path.join(scp_task_kb_path, category)) for category in categories}
+
+
+def build_unified_kb(scp_task_kb_path, categories, unified_kb_path=None):
+    '''
+    Merge the category KBs of scp_task_kb_path into a single KB with one embedding matrix and one docstore.
+    The rows of each category are stored contiguously and their range is recorded under its information_category
+    (the category folder name), so a category filtered search only scores the rows of that category.
+    The fingerprints of the category KBs are recorded, so is_unified_kb_current detects when one of them changed.
+    '''
+    if unified_kb_path is None:
+        unified_kb_path = get_unified_kb_path(scp_task_kb_path)
+    if not os.path.exists(unified_kb_path):
+        os.makedirs(unified_kb_path)
+
+    embeddings, ids, category_ranges, node_records, embed_model_names, source_fingerprints = [], [], {}, [], set(), {}
+    for category in categories:
+        KB_path = os.path.join(scp_task_kb_path, category)
+        if not has_kb_embeddings(KB_path):
+            raise ValueError(f'No exported embeddings in {KB_path}, run export_kb_embeddings first.')
+        source_fingerprints[category] = get_kb_fingerprint(KB_path)
+        category_embeddings = np.load(os.path.join(KB_path, EMBEDDINGS_FILE))
+        if len(embeddings) > 0 and category_embeddings.shape[1] != embeddings[0].shape[1]:
+            raise ValueError(f'Embedding dimension of {KB_path} does not match the other categories, the KBs must use the same embedding model.')
+        with open(os.path.join(KB_path, EMBEDDING_IDS_FILE)) as f:
+            embedding_ids = json.load(f)
+        category_ids = embedding_ids['ids']
+        embed_model_names.add(embedding_ids.get('embed_model'))
+
+        category_ranges[category] = [len(ids), len(ids) + len(category_ids)]
+        embeddings.append(category_embeddings)
+        ids += category_ids
+        node_records += _read_node_records(KB_path)
+
+    np.save(os.path.join(unified_kb_path, EMBEDDINGS_FILE), np.concatenate(embeddings, axis=0))
+    with open(os.path.join(unified_kb_path, EMBEDDING_IDS_FILE), 'w') as f:
+        json.dump({'ids': ids, 'category_ranges': category_ranges, 'embed_model': embed_model_names.pop() if len(embed_model_names) == 1 else None,
+                   'source_fingerprints': source_fingerprints}, f)
+    _write_node_records(os.path.join(unified_kb_path, DOCSTORE_SQLITE_FILE), node_records)
+
+    export_bm25_index(unified_kb_path)
+    # the precomputed ColBERT token embeddings are merged as well if every category has them
+    if all(has_colbert_tokens(os.path.join(scp_task_kb_path, category)) for category in categories):
+        merge_colbert_tokens(scp_task_kb_path, unified_kb_path)
+    # a store of the previous version loaded in this process is reloaded on next use
+    with _kb_stores_lock:
+        _kb_stores.pop(os.path.normpath(unified_kb_path), None)
+    return unified_kb_path
+
+
+def merge_colbert_tokens(scp_task_kb_path, unified_kb_path=None):
+    # store the ColBERT token embeddings of the category KBs with the unified KB, in the row order of its embeddings
+    if unified_kb_path is None:
+        unified_kb_path = get_unified_kb_path(scp_task_kb_path)
+    with open(os.path.join(unified_kb_path, EMBEDDING_IDS_FILE)) as f:
+        embedding_ids = json.load(f)
+
+    token_embeddings, store_versions = [], set()
+    for category, (start, end) in embedding_ids['category_ranges'].items():
+        token_store = ColbertTokenStore(os.path.join(scp_task_kb_path, category))
+        store_versions.add((token_store.model_name, token_store.text_mode))
+        for node_id in embedding_ids['ids'][start:end]:
+            node_token_embeddings = token_store.get(node_id)
+            if node_token_embeddings is None:
+                raise ValueError(f'Node {node_id} has no ColBERT token embeddings in {token_store.KB_path}, export them again.')
+            token_embeddings.append(node_token_embeddings)
+    if len(store_versions) > 1:
+        raise ValueError(f'The ColBERT token embeddings of the categories were computed with different models or node texts: {store_versions}')
+    model_name, text_mode = store_versions.pop()
+    save_colbert_tokens(unified_kb_path, embedding_ids['ids'], token_embeddings, model_name, text_mode)
+
+
+class SQLiteNodeStore():
+    '''
+    Read-only, memory-mapped node store written by convert_docstore_to_sqlite.
+    Nodes are decompressed and materialized only when they are requested.
+    '''
+    def __init__(self, KB_path, mmap_size_mb=256):
+        self.db_path = os.path.join(KB_path, DOCSTORE_SQLITE_FILE)
+        self.conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        self.conn.execute(f'PRAGMA mmap_size={int(mmap_size_mb * 1024 * 1024)}')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def get_nodes(self, node_ids):
+        node_ids = list(node_ids)
+        rows = {}
+        # queried in chunks to stay below the SQLite variable limit
+        for start in range(0, len(node_ids), 500):
+            chunk = node_ids[start:start + 500]
+            with self.lock:
+                rows.update(self.conn.execute(f'SELECT node_id, data FROM nodes WHERE node_id IN ({",".join("?" * len(chunk))})', chunk).fetchall())
+
+        nodes = []
+        for node_id in node_ids:
+            if node_id not in rows:
+                raise ValueError(f'Node {node_id} not found in {self.db_path}.')
+            nodes.append(json_to_doc(json.loads(zlib.decompress(rows[node_id]).decode('utf-8'))))
+        return nodes
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class KBStore():
+    '''
+    Memory-mapped embedding matrix of a KB together with its nodes.
+    '''
+    def __init__(self, KB_path):
+        self.KB_path = KB_path
+        self.embeddings = np.load(os.path.join(KB_path, EMBEDDINGS_FILE), mmap_mode='r')
+        with open(os.path.join(KB_path, EMBEDDING_IDS_FILE)) as f:
+            embedding_ids = json.load(f)
+        self.ids = embedding_ids['ids']
+        # row range of every information_category in a unified KB
+        self.category_ranges = embedding_ids.get('category_ranges', {})
+        self.embed_model_name = embedding_ids.get('embed_model')
+        self.bm25_index = BM25Index.load(KB_path) if has_bm25_index(KB_path) else None
+        if os.path.exists(os.path.join(KB_path, DOCSTORE_SQLITE_FILE)):
+            self.docstore = SQLiteNodeStore(KB_path)
+        else:
+            self.docstore = SimpleDocumentStore.from_persist_dir(KB_path)
+
+    def check_embed_model(self, embed_model_name):
+        # the KB can only be searched with query embeddings of the model its nodes were embedded with
+        if self.embed_model_name is not None and embed_model_name != self.embed_model_name:
+            raise ValueError(f'{self.KB_path} was embedded with {self.embed_model_name}, but the active embedding model is {embed_model_name}. '
+                             f'Use the embedding provider the KB was built with, or rebuild the KB.')
+
+    def get_category_range(self, information_category):
+        if information_category is None:
+            return 0, len(self.ids)
+        if information_category not in self.category_ranges:
+            raise ValueError(f'Unknown information_category {information_category} in {self.KB_path}, available: {list(self.category_ranges.keys())}')
+        return tuple(self.category_ranges[information_category])
+
+    def search(self, query_embeddings, top_k, information_categories=None, chunk_size=8192):
+        # brute-force cosine similarity search, returns a list of (node_ids, scores) per query
+        # information_categories optionally restricts each query to the rows of one category of a unified KB
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if query_embeddings.shape[1] != self.embeddings.shape[1]:
+            raise ValueError(f'Query embedding dimension {query_embeddings.shape[1]} does not match the KB embedding dimension {self.embeddings.shape[1]} in {self.KB_path}.')
+        query_embeddings = query_embeddings / np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+
+        # scored in chunks so that float16 rows are upcast a few at a time
+        scores = np.empty((query_embeddings.shape[0], self.embeddings.shape[0]), dtype=np.float32)
+        for start in range(0, self.embeddings.shape[0], chunk_size):
+            scores[:, start:start + chunk_size] = query_embeddings @ np.asarray(self.embeddings[start:start + chunk_size], dtype=np.float32).T
+
+        if information_categories is None:
+            information_categories = [None] * len(scores)
+        results = []
+        for query_scores, information_category in zip(scores, information_categories):
+            start, end = self.get_category_range(information_category)
+            query_scores = query_scores[start:end]
+            query_top_k = min(top_k, len(query_scores))
+            if query_top_k == 0:
+                results.append(([], []))
+                continue
+            top_indices = np.argpartition(-query_scores, query_top_k - 1)[:query_top_k]
+            top_indices = top_indices[np.argsort(-query_scores[top_indices])]
+            results.append(([self.ids[start + i] for i in top_indices], [float(query_scores[i]) for i in top_indices]))
+        return results
+
+    def search_bm25(self, query_str, top_k, information_category=None):
+        # sparse BM25 search over the node text and keywords, returns (node_ids, scores)
+        start, end = self.get_category_range(information_category)
+        return self.bm25_index.search(query_str, top_k, start=start, end=end)
+
+    def get_nodes(self, node_ids):
+        return self.docstore.get_nodes(node_ids)
+
+
+# process-wide cache of loaded KB stores
+_kb_stores = {}
+_kb_stores_lock = threading.Lock()
+
+
+def load_kb_store(KB_path):
+    KB_path = os.path.normpath(KB_path)
+    with _kb_stores_lock:
+        if KB_path not in _kb_stores:
+            _kb_stores[KB_path] = KBStore(KB_path)
+    return _kb_stores[KB_path]
+
+
+def has_kb_embeddings(KB_path):
+    return os.path.exists(os.path.join(KB_path, EMBEDDINGS_FILE)) and os.path.exists(os.path.join(KB_path, EMBEDDING_IDS_FILE))
+
+
+class KBRetriever(BaseRetriever):
+    '''
+    Dense retriever over the memory-mapped embeddings of a KB.
+    For a unified KB, information_category limits the retrieval to the nodes of one category.
+    If the KB has a BM25 index and use_bm25 is set, the dense and BM25 rankings (sparse_top_k each) are fused with
+    reciprocal rank fusion, so exact drug and test names are found even if they rank low in the dense search.
+    '''
+    def __init__(self, KB_path, similarity_top_k=30, embed_model=None, information_category=None, use_bm25=True, sparse_top_k=None, rrf_k=60):
+        self.kb_store = load_kb_store(KB_path)
+        self.similarity_top_k = similarity_top_k
+        self.embed_model = embed_model
+        self.information_category = information_category
+        self.use_bm25 = use_bm25 and self.kb_store.bm25_index is not None
+        self.sparse_top_k = sparse_top_k if sparse_top_k is not None else similarity_top_k
+        self.rrf_k = rrf_k
+        # fail at load time rather than on the first query
+        self.kb_store.get_category_range(information_category)
+        self.kb_store.check_embed_model(self.query_embed_model.model_name)
+        super().__init__()
+
+    @property
+    def query_embed_model(self):
+        return self.embed_model if self.embed_model is not None else Settings.embed_model
+
+    def get_query_embedding(self, query_bundle):
+        if query_bundle.embedding is not None:
+            return query_bundle.embedding
+        return self.query_embed_model.get_query_embedding(query_bundle.query_str)
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        node_ids, scores = self.kb_store.search(self.get_query_embedding(query_bundle), self.similarity_top_k, information_categories=[self.information_category])[0]
+        if self.use_bm25:
+            sparse_node_ids, _ = self.kb_store.search_bm25(query_bundle.query_str, self.sparse_top_k, information_category=self.information_category)
+            node_ids, scores = reciprocal_rank_fusion([node_ids, sparse_node_ids], self.similarity_top_k, rrf_k=self.rrf_k)
+        nodes = self.kb_store.get_nodes(node_ids)
+        return [NodeWithScore(node=node, score=score) for node, score in zip(nodes, scores)]
+
+
+if __name__ == '__main__':
+    # export the embeddings and the SQLite docstore of every category KB and merge them into the unified KB, e.g.
+    # python -m scp_utils.kb_store ./kbs/VI_2_text-embedding-3-large azure
+    from models.embedding_models import get_embedding_model
+
+    scp_task_kb_path = sys.argv[1] if len(sys.argv) > 1 else './kbs/VI_2_text-embedding-3-large'
+    embedding_provider = sys.argv[2] if len(sys.argv) > 2 else 'azure' # the provider the KB was built with, 'azure' or 'local'
+
+    Settings.embed_model = get_embedding_model(embedding_provider)
+
+    categories = []
+    for category in sorted(os.listdir(scp_task_kb_path)):
+        KB_path = os.path.join(scp_task_kb_path, category)
+        if os.path.isdir(KB_path) and os.path.exists(os.path.join(KB_path, 'docstore.json')):
+            print(f'Exporting embeddings for {category}...')
+            export_kb_embeddings(KB_path)
+            convert_docstore_to_sqlite(KB_path)
+            export_bm25_index(KB_path)
+            categories.append(category)
+
+    print(f'Unified KB saved to {build_unified_kb(scp_task_kb_path, categories)}')
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_tasks_in_parallel(tasks, max_workers=8, default=None):
+    '''
+    Run independent tasks on a bounded thread pool.
+
+    tasks: dict of task_name -> callable taking no arguments.
+    Returns a dict with the same keys in the same order. A failing task does not cancel
+    the others; its exception is printed and its result is set to `default`.
+    '''
+    results = {}
+    if max_workers is None or max_workers <= 1:
+        for task_name, task_fn in tasks.items():
+            try:
+                results[task_name] = task_fn()
+            except Exception as e:
+                print(f'Task {task_name} failed: {e}')
+                results[task_name] = default
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, max(len(tasks), 1))) as executor:
+        futures = {task_name: executor.submit(task_fn) for task_name, task_fn in tasks.items()}
+        for task_name, future in futures.items():
+            try:
+                results[task_name] = future.result()
+            except Exception as e:
+                print(f'Task {task_name} failed: {e}')
+                results[task_name] = default
+
+    return results
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from llama_index.core import Settings
+
+
+class QueryEmbeddingBatcher():
+    '''
+    Query embedder shared by the section retrievers.
+    Queries requested concurrently (the five sections of a patient, or the sections of all patients of a cohort run)
+    are collected for up to max_wait_ms and embedded in batched requests of at most max_batch_size queries.
+    Embeddings are cached by query text, so a repeated query is not embedded again.
+    '''
+    def __init__(self, embed_model=None, max_batch_size=16, max_wait_ms=20, cache_size=4096):
+        self._embed_model = embed_model
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.pending = {} # query text -> Future of queries that are queued or being embedded
+        self.queue = []
+        self.flush_scheduled = False
+        self.hits = 0
+        self.misses = 0
+        self.num_batches = 0
+
+    @property
+    def embed_model(self):
+        # resolved at call time so that Settings.embed_model can be set after the resources are loaded
+        return self._embed_model if self._embed_model is not None else Settings.embed_model
+
+    @property
+    def model_name(self):
+        return self.embed_model.model_name
+
+    def get_query_embedding(self, query_str):
+        batch = None
+        with self.lock:
+            if query_str in self.cache:
+                self.cache.move_to_end(query_str)
+                self.hits += 1
+                return self.cache[query_str]
+            self.misses += 1
+
+            future = self.pending.get(query_str)
+            if future is None:
+                future = Future()
+                self.pending[query_str] = future
+                self.queue.append(query_str)
+                if len(self.queue) >= self.max_batch_size:
+                    # a full batch is embedded right away by the thread that completed it
+                    batch = self.queue[:self.max_batch_size]
+                    self.queue = self.queue[self.max_batch_size:]
+                elif not self.flush_scheduled:
+                    self.flush_scheduled = True
+                    timer = threading.Timer(self.max_wait_s, self._flush)
+                    timer.daemon = True
+                    timer.start()
+
+        if batch is not None:
+            self._embed_batch(batch)
+        return future.result()
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            queued, self.queue = self.queue, []
+        for start in range(0, len(queued), self.max_batch_size):
+            self._embed_batch(queued[start:start + self.max_batch_size])
+
+    def _embed_batch(self, batch):
+        # OpenAI text-embedding-3 embeds queries and texts the same way, so its batched text embedding call is used for the queries,
+        # models with a query instruction (LocalSentenceTransformerEmbedding with bge) embed the batch as queries
+        try:
+            if hasattr(self.embed_model, 'get_query_embedding_batch'):
+                embeddings = self.embed_model.get_query_embedding_batch(batch)
+            else:
+                embeddings = self.embed_model.get_text_embedding_batch(batch)
+        except Exception as e:
+            with self.lock:
+                futures = [self.pending.pop(query) for query in batch]
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self.lock:
+            self.num_batches += 1
+            futures = []
+            for query, embedding in zip(batch, embeddings):
+                self.cache[query] = embedding
+                futures.append(self.pending.pop(query))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        for future, embedding in zip(futures, embeddings):
+            future.set_result(embedding)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / max(self.hits + self.misses, 1),
+                    'batches': self.num_batches,
+                    'cached_queries': len(self.cache)}
@@ -0,0 +1,356 @@
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, MetadataMode
+
+from scp_utils.kb_store import load_kb_nodes, save_colbert_tokens, merge_colbert_tokens, has_colbert_tokens, ColbertTokenStore, has_kb_embeddings, get_unified_kb_path, UNIFIED_KB_FOLDER
+
+
+# node text encoded by the ColBERT reranker, recorded with the precomputed token embeddings so that stores
+# encoded from another text are not used
+COLBERT_TEXT_MODE = 'content'
+
+
+def colbert_node_text(node):
+    # the plain node text without metadata, as encoded by llama_index ColbertRerank
+    return node.get_content()
+
+
+class BatchedReranker():
+    '''
+    Base class of the rerankers.
+    Rerank requests made concurrently by the section retrievers (and by the patients of a cohort run) are collected
+    for up to max_wait_ms and scored together by score_batch, so the model runs one batched pass for all of them.
+    '''
+    name = 'none'
+
+    def __init__(self, top_n=20, keep_retrieval_score=True, max_wait_ms=50, max_batch_requests=8):
+        self.top_n = top_n
+        self.keep_retrieval_score = keep_retrieval_score
+        self.max_wait_s = max_wait_ms / 1000
+        self.max_batch_requests = max_batch_requests
+
+        self.lock = threading.Lock()
+        self.queue = []
+        self.flush_scheduled = False
+
+    def score_batch(self, queries, nodes_lists):
+        # one list of scores per (query, nodes) request
+        raise NotImplementedError
+
+    def rerank(self, query_str, nodes, top_n=None):
+        # nodes are NodeWithScore from the retriever, the top_n best scoring nodes are returned
+        top_n = top_n if top_n is not None else self.top_n
+        if len(nodes) == 0:
+            return []
+
+        future = Future()
+        batch = None
+        with self.lock:
+            self.queue.append((query_str, nodes, future))
+            if len(self.queue) >= self.max_batch_requests:
+                batch, self.queue = self.queue, []
+            elif not self.flush_scheduled:
+                self.flush_scheduled = True
+                timer = threading.Timer(self.max_wait_s, self._flush)
+                timer.daemon = True
+                timer.start()
+
+        if batch is not None:
+            self._score_requests(batch)
+        return self._select(nodes, future.result(), top_n)
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            batch, self.queue = self.queue, []
+        if len(batch) > 0:
+            self._score_requests(batch)
+
+    def _score_requests(self, batch):
+        try:
+            scores_lists = self.score_batch([query_str for query_str, _, _ in batch], [nodes for _, nodes, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), scores in zip(batch, scores_lists):
+            future.set_result(scores)
+
+    def _select(self, nodes, scores, top_n):
+        reranked_nodes = []
+        for node, score in zip(nodes, scores):
+            reranked_node = node.node
+            if self.keep_retrieval_score:
+                # copied so that the shared KB node (and its embedded text) is not modified
+                reranked_node = node.node.model_copy(update={'metadata': {**node.node.metadata, 'retrieval_score': node.score}})
+            reranked_nodes.append(NodeWithScore(node=reranked_node, score=float(score)))
+        reranked_nodes = sorted(reranked_nodes, key=lambda x: -x.score)
+        return reranked_nodes if top_n is None else reranked_nodes[:top_n]
+
+
+class NoReranker(BatchedReranker):
+    '''
+    Keeps the retriever ranking, optionally truncated to top_n.
+    '''
+    name = 'none'
+
+    def __init__(self, top_n=None):
+        super().__init__(top_n=top_n)
+
+    def rerank(self, query_str, nodes, top_n=None):
+        top_n = top_n if top_n is not None else self.top_n
+        return nodes if top_n is None else nodes[:top_n]
+
+
+class CrossEncoderReranker(BatchedReranker):
+    '''
+    Scores the (query, node text) pairs of all batched requests with one cross encoder predict call.
+    '''
+    name = 'cross-encoder'
+
+    def __init__(self, model_name='cross-encoder/ms-marco-MiniLM-L-12-v2', device='cpu', top_n=20, batch_size=32, cross_encoder=None, **kwargs):
+        super().__init__(top_n=top_n, **kwargs)
+        if cross_encoder is None:
+            from sentence_transformers import CrossEncoder
+            cross_encoder = CrossEncoder(model_name=model_name, device=device)
+        self.cross_encoder = cross_encoder
+        self.batch_size = batch_size
+
+    def score_batch(self, queries, nodes_lists):
+        pairs = [[query_str, node.node.get_content(metadata_mode=MetadataMode.EMBED)] for query_str, nodes in zip(queries, nodes_lists) for node in nodes]
+        scores = self.cross_encoder.predict(pairs, batch_size=self.batch_size)
+        scores_lists, offset = [], 0
+        for nodes in nodes_lists:
+            scores_lists.append(scores[offset:offset + len(nodes)])
+            offset += len(nodes)
+        return scores_lists
+
+
+class ColbertReranker(BatchedReranker):
+    '''
+    ColBERT late interaction reranker, scored as in llama_index ColbertRerank: the plain node text (colbert_node_text)
+    is encoded, and scored by the cosine similarity of the query and document token embeddings, max over the document
+    tokens and mean over the query tokens.
+    The queries and the uncached documents of all batched requests are encoded in padded batches, and the token
+    embeddings of KB nodes are kept in an in-memory LRU cache since the same guideline nodes are retrieved repeatedly.
+    With the token embeddings precomputed at KB build time (add_token_store), only the queries are encoded.
+    '''
+    name = 'colbert'
+
+    def __init__(self, model_name='colbert-ir/colbertv2.0', device='cpu', top_n=20, batch_size=32, max_length=512, doc_cache_size=2048, **kwargs):
+        super().__init__(top_n=top_n, **kwargs)
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+
+        self.torch = torch
+        self.model_name = model_name
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(device).eval()
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        self.doc_cache_size = doc_cache_size
+        self.doc_cache = OrderedDict()
+        self.doc_cache_lock = threading.Lock()
+        self.token_stores = []
+
+    def encode(self, texts):
+        # L2-normalized token embeddings of every text without padding, as float16 numpy arrays
+        token_embeddings = [None] * len(texts)
+        # sorted by length so that each padded batch holds texts of similar length
+        order = np.argsort([len(text) for text in texts])
+        for start in range(0, len(texts), self.batch_size):
+            batch_indices = order[start:start + self.batch_size]
+            encoding = self.tokenizer([texts[i] for i in batch_indices], return_tensors='pt', padding=True, truncation=True, max_length=self.max_length).to(self.device)
+            with self.torch.inference_mode():
+                hidden_states = self.model(**encoding).last_hidden_state
+                hidden_states = self.torch.nn.functional.normalize(hidden_states, dim=-1)
+            for i, hidden_state, attention_mask in zip(batch_indices, hidden_states, encoding['attention_mask']):
+                token_embeddings[i] = hidden_state[attention_mask.bool()].to('cpu', dtype=self.torch.float16).numpy()
+        return token_embeddings
+
+    def is_compatible(self, token_store):
+        # True if the token store was encoded with this model from the node text the reranker encodes
+        return token_store.model_name == self.model_name and token_store.text_mode == COLBERT_TEXT_MODE
+
+    def add_token_store(self, token_store):
+        # precomputed token embeddings of a KB (ColbertTokenStore), used instead of encoding its nodes
+        if not self.is_compatible(token_store):
+            print(f'Skipping the ColBERT token embeddings of {token_store.KB_path}, they were computed with {token_store.model_name} '
+                  f'from the {token_store.text_mode or "embed"} node text instead of {self.model_name} from the {COLBERT_TEXT_MODE} node text, '
+                  f'export them again with python -m scp_utils.rerankers.')
+            return
+        self.token_stores.append(token_store)
+
+    def get_doc_token_embeddings(self, nodes):
+        # token embeddings of the nodes, from the precomputed token stores, the cache or encoded together in one pass
+        doc_embeddings = {}
+        for node in nodes:
+            for token_store in self.token_stores:
+                token_embeddings = token_store.get(node.node.node_id)
+                if token_embeddings is not None:
+                    doc_embeddings[node.node.node_id] = token_embeddings
+                    break
+        with self.doc_cache_lock:
+            for node in nodes:
+                if node.node.node_id not in doc_embeddings and node.node.node_id in self.doc_cache:
+                    self.doc_cache.move_to_end(node.node.node_id)
+                    doc_embeddings[node.node.node_id] = self.doc_cache[node.node.node_id]
+
+        missing = {node.node.node_id: colbert_node_text(node.node) for node in nodes if node.node.node_id not in doc_embeddings}
+        if len(missing) > 0:
+            encoded = self.encode(list(missing.values()))
+            with self.doc_cache_lock:
+                for node_id, token_embeddings in zip(missing.keys(), encoded):
+                    doc_embeddings[node_id] = token_embeddings
+                    self.doc_cache[node_id] = token_embeddings
+                while len(self.doc_cache) > self.doc_cache_size:
+                    self.doc_cache.popitem(last=False)
+        return doc_embeddings
+
+    def score_batch(self, queries, nodes_lists):
+        query_embeddings = self.encode(queries)
+        doc_embeddings = self.get_doc_token_embeddings([node for nodes in nodes_lists for node in nodes])
+
+        scores_lists = []
+        for query_embedding, nodes in zip(query_embeddings, nodes_lists):
+            doc_token_embeddings = [doc_embeddings[node.node.node_id] for node in nodes]
+            # the documents of a request are scored with one matrix product over their concatenated tokens
+            sim = query_embedding.astype(np.float32) @ np.concatenate(doc_token_embeddings, axis=0).astype(np.float32).T
+            offsets = np.cumsum([0] + [len(x) for x in doc_token_embeddings[:-1]])
+            max_sim = np.maximum.reduceat(sim, offsets, axis=1)
+            scores_lists.append(max_sim.mean(axis=0))
+        return scores_lists
+
+
+class PostprocessorReranker(BatchedReranker):
+    '''
+    Adapter for a llama_index node postprocessor (e.g. ColbertRerank), applied to each request separately.
+    '''
+    def __init__(self, postprocessor):
+        super().__init__(top_n=getattr(postprocessor, 'top_n', None))
+        self.postprocessor = postprocessor
+        self.name = type(postprocessor).__name__
+
+    def rerank(self, query_str, nodes, top_n=None):
+        return self.postprocessor.postprocess_nodes(nodes, query_bundle=QueryBundle(query_str))
+
+
+def get_reranker(name, top_n=20, device='cpu', **kwargs):
+    '''
+    name: 'none', 'cross-encoder' or 'colbert'.
+    '''
+    if name == 'none':
+        # keeps all retrieved candidates
+        return NoReranker()
+    elif name == 'cross-encoder':
+        return CrossEncoderReranker(device=device, top_n=top_n, **kwargs)
+    elif name == 'colbert':
+        return ColbertReranker(device=device, top_n=top_n, **kwargs)
+    else:
+        raise ValueError(f"Unknown reranker {name}, expected 'none', 'cross-encoder' or 'colbert'.")
+
+
+def get_section_rerankers(reranker, categories, top_n=20, device='cpu'):
+    '''
+    Reranker of every section category. reranker is a name or reranker object used for all sections, or a dict
+    with one per category. Sections configured with the same name share one reranker instance, so their
+    requests are batched together.
+    '''
+    section_config = reranker if isinstance(reranker, dict) else {category: reranker for category in categories}
+    rerankers_by_name = {}
+    section_rerankers = {}
+    for category in categories:
+        config = section_config.get(category, 'none')
+        if config is None:
+            config = 'none'
+        if isinstance(config, str):
+            if config not in rerankers_by_name:
+                rerankers_by_name[config] = get_reranker(config, top_n=top_n, device=device)
+            section_rerankers[category] = rerankers_by_name[config]
+        elif isinstance(config, BatchedReranker):
+            section_rerankers[category] = config
+        else:
+            section_rerankers[category] = PostprocessorReranker(config)
+    return section_rerankers
+
+
+class RerankingRetriever(BaseRetriever):
+    '''
+    Retrieves the candidates of a section with retriever and reranks them with reranker, reporting the time of both stages.
+    '''
+    def __init__(self, retriever, reranker, section_name=''):
+        self.retriever = retriever
+        self.reranker = reranker
+        self.section_name = section_name
+        self.lock = threading.Lock()
+        self.timings = {'calls': 0, 'retrieval_s': 0.0, 'rerank_s': 0.0}
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        start_time = time.perf_counter()
+        nodes = self.retriever.retrieve(query_bundle)
+        retrieval_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        reranked_nodes = self.reranker.rerank(query_bundle.query_str, nodes)
+        rerank_time = time.perf_counter() - start_time
+
+        with self.lock:
+            self.timings['calls'] += 1
+            self.timings['retrieval_s'] += retrieval_time
+            self.timings['rerank_s'] += rerank_time
+        print(f'{self.section_name}: retrieved {len(nodes)} nodes in {retrieval_time:.2f}s, reranked to {len(reranked_nodes)} ({self.reranker.name}) in {rerank_time:.2f}s')
+        return reranked_nodes
+
+    def stats(self):
+        with self.lock:
+            return dict(self.timings)
+
+
+def export_colbert_token_embeddings(KB_path, colbert_reranker):
+    '''
+    Encode the nodes of a KB with the ColBERT model of colbert_reranker and store the token embeddings with the KB.
+    The nodes are encoded from the same text as the reranker encodes at query time (colbert_node_text).
+    Token embeddings already stored for a node (with the same model and node text) are reused, so an updated KB only encodes its new nodes.
+    '''
+    node_ids, nodes = load_kb_nodes(KB_path)
+
+    stored = {}
+    if has_colbert_tokens(KB_path):
+        token_store = ColbertTokenStore(KB_path)
+        if colbert_reranker.is_compatible(token_store):
+            # copied out of the memory map, the file is overwritten below
+            stored = {node_id: np.array(token_store.get(node_id)) for node_id in node_ids if token_store.get(node_id) is not None}
+        del token_store
+
+    missing = [i for i, node_id in enumerate(node_ids) if node_id not in stored]
+    print(f'Encoding {len(missing)} of {len(nodes)} nodes of {KB_path} with {colbert_reranker.model_name}...')
+    encoded = colbert_reranker.encode([colbert_node_text(nodes[i]) for i in missing]) if len(missing) > 0 else []
+    for i, token_embeddings in zip(missing, encoded):
+        stored[node_ids[i]] = token_embeddings
+    save_colbert_tokens(KB_path, node_ids, [stored[node_id] for node_id in node_ids], colbert_reranker.model_name, COLBERT_TEXT_MODE)
+
+
+if __name__ == '__main__':
+    # precompute the ColBERT token embeddings of every category KB and the unified KB, e.g.
+    # python -m scp_utils.rerankers ./kbs/VI_2_text-embedding-3-large
+    scp_task_kb_path = sys.argv[1] if len(sys.argv) > 1 else './kbs/VI_2_text-embedding-3-large'
+    device = sys.argv[2] if len(sys.argv) > 2 else 'cpu'
+
+    colbert_reranker = ColbertReranker(device=device)
+    for category in sorted(os.listdir(scp_task_kb_path)):
+        KB_path = os.path.join(scp_task_kb_path, category)
+        if category != UNIFIED_KB_FOLDER and os.path.isdir(KB_path) and os.path.exists(os.path.join(KB_path, 'docstore.json')):
+            export_colbert_token_embeddings(KB_path, colbert_reranker)
+
+    if has_kb_embeddings(get_unified_kb_path(scp_task_kb_path)):
+        merge_colbert_tokens(scp_task_kb_path)
@@ -0,0 +1,95 @@
+import hashlib
+import numpy as np
+
+from scp_utils.chunk_filter import WORD_PATTERN
+
+
+# Mersenne prime of the MinHash permutations, shingle hashes are reduced modulo it so that a * x + b fits in uint64
+MINHASH_PRIME = (1 << 31) - 1
+
+
+def shingle_set(text, shingle_size=3):
+    # lower-cased word shingles, texts shorter than a shingle are a single shingle
+    words = [word.lower() for word in WORD_PATTERN.findall(text)]
+    return {' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+
+
+def jaccard_similarity(shingles_a, shingles_b):
+    return len(shingles_a & shingles_b) / max(len(shingles_a | shingles_b), 1)
+
+
+class MinHasher():
+    '''
+    MinHash signatures of shingle sets, with num_bands LSH bands to find the candidate near-duplicate pairs.
+    '''
+    def __init__(self, num_perm=128, num_bands=32, seed=0):
+        assert num_perm % num_bands == 0, 'num_perm must be a multiple of num_bands'
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingles):
+        hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big') % MINHASH_PRIME
+                           for shingle in shingles], dtype=np.uint64)
+        return ((np.outer(hashes, self.a) + self.b) % MINHASH_PRIME).min(axis=0)
+
+    def candidate_pairs(self, signatures):
+        # pairs of rows that agree on all the rows of at least one band
+        rows_per_band = self.num_perm // self.num_bands
+        candidates = set()
+        for band in range(self.num_bands):
+            buckets = {}
+            for i, signature in enumerate(signatures):
+                buckets.setdefault(signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes(), []).append(i)
+            for bucket in buckets.values():
+                for j in range(len(bucket)):
+                    for k in range(j + 1, len(bucket)):
+                        candidates.add((bucket[j], bucket[k]))
+        return candidates
+
+
+def cluster_near_duplicates(texts, threshold=0.7, min_hasher=None):
+    '''
+    Cluster near-duplicate texts, returns a list of clusters (lists of indices into texts) with the leader first.
+    Texts are visited from longest to shortest, and each text that is not yet clustered becomes the leader of the
+    texts whose shingle Jaccard similarity to it is at least threshold. Only the MinHash LSH candidates are compared.
+    '''
+    min_hasher = min_hasher if min_hasher is not None else MinHasher()
+    shingles = [shingle_set(text) for text in texts]
+    signatures = [min_hasher.signature(shingle) for shingle in shingles]
+    neighbours = {i: [] for i in range(len(texts))}
+    for i, j in min_hasher.candidate_pairs(signatures):
+        if jaccard_similarity(shingles[i], shingles[j]) >= threshold:
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+
+    clusters = []
+    clustered = set()
+    for i in sorted(range(len(texts)), key=lambda i: (-len(texts[i]), i)):
+        if i in clustered:
+            continue
+        cluster = [i] + sorted(j for j in neighbours[i] if j not in clustered)
+        clustered.update(cluster)
+        clusters.append(cluster)
+    # in the order of the first text of each cluster, so the knowledge keeps the order of the rules files
+    return sorted(clusters, key=min)
+
+
+def merge_rule_cluster(kb_docs):
+    '''
+    Merge a cluster of knowledge entries ({'text', 'metadata'}) into the first (leader) entry.
+    The title and page of every entry are kept in metadata['merged_sources'] and the keywords are combined,
+    the source texts are not kept since the metadata of a node must fit in its chunk size.
+    '''
+    if len(kb_docs) == 1:
+        return kb_docs[0]
+    merged_doc = {'text': kb_docs[0]['text'], 'metadata': dict(kb_docs[0]['metadata'])}
+    keywords = []
+    for kb_doc in kb_docs:
+        keywords += [keyword for keyword in kb_doc['metadata'].get('keywords', []) if keyword not in keywords]
+    merged_doc['metadata']['keywords'] = keywords
+    merged_doc['metadata']['merged_sources'] = [{key: kb_doc['metadata'].get(key) for key in ('doc_title', 'page_number')}
+                                                for kb_doc in kb_docs]
+    return merged_doc
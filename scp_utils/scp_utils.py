@@ -3,20 +3,40 @@ import numpy as np
 import os
 from llama_index.core import StorageContext, load_index_from_storage
 
-
-def create_KB_retriever(KB_path,reranker,top_kb_k=50):
-    
-    storage_context = StorageContext.from_defaults(persist_dir=KB_path)
-    
-    # load index
-    index = load_index_from_storage(storage_context)
-    
-    kb_retriever = index.as_retriever(
-        similarity_top_k=top_kb_k,
-        node_postprocessors=[reranker]
-    )
+from scp_utils.kb_store import KBRetriever, has_kb_embeddings
+from scp_utils.rerankers import BatchedReranker, PostprocessorReranker, RerankingRetriever
+
+
+def create_KB_retriever(KB_path,reranker,top_kb_k=50,information_category=None,query_embedder=None,use_bm25=True):
+    # reranker is a reranker from scp_utils.rerankers (or a llama_index node postprocessor) applied to the top_kb_k candidates,
+    # or None to return the candidates as retrieved
+    
+    if has_kb_embeddings(KB_path):
+        # search the memory-mapped embedding matrix stored with the KB instead of loading the vector store
+        # information_category selects one category of a unified KB
+        # a shared query_embedder (QueryEmbeddingBatcher) embeds the queries of concurrent retrievals in batches
+        # with use_bm25, the dense ranking is fused with the BM25 ranking if the KB has a BM25 index
+        kb_retriever = KBRetriever(KB_path, similarity_top_k=top_kb_k, embed_model=query_embedder, information_category=information_category, use_bm25=use_bm25)
+    else:
+        if information_category is not None:
+            raise ValueError(f'{KB_path} has no exported embeddings, information_category filtering requires a unified KB built with build_unified_kb.')
+        
+        storage_context = StorageContext.from_defaults(persist_dir=KB_path)
+        
+        # load index
+        index = load_index_from_storage(storage_context)
         
-    return kb_retriever
+        kb_retriever = index.as_retriever(
+            similarity_top_k=top_kb_k,
+        )
+    
+    if reranker is None:
+        return kb_retriever
+    # the reranker is applied explicitly, as_retriever does not apply node_postprocessors
+    if not isinstance(reranker, BatchedReranker):
+        reranker = PostprocessorReranker(reranker)
+    section_name = information_category if information_category is not None else os.path.basename(os.path.normpath(KB_path))
+    return RerankingRetriever(kb_retriever, reranker, section_name=section_name)
 
 
 def extract_completed_treatment_agents(treatment_summary):
@@ -54,6 +74,58 @@ def extract_ongoing_treatment_agents(treatment_summary):
     return agents
 
 
+def match_agents_to_drugs(all_agents,cross_encoder,drug_names_list,drug_name_index=None):
+    # for each agent, select the top matching drug name in drug_names_list using the cross encoder
+    if drug_name_index is not None:
+        # only the shortlist of most similar drug names from the embedding index is scored
+        return drug_name_index.match(all_agents, cross_encoder)
+    
+    # otherwise, get cross_encoder score with each drug name in drug_names_list
+    drug_scores = {}
+    for agent in all_agents:
+        #create a batch of cross_encoder inputs
+        cross_encoder_input = [[agent,drug_name] for drug_name in drug_names_list]
+        #get cross_encoder scores
+        scores = cross_encoder.predict(cross_encoder_input)
+        # get the top matching drug
+        top_score_index = np.argmax(scores)
+        drug_scores[agent] = drug_names_list[top_score_index]
+    return drug_scores
+
+
+def resolve_patient_drugs(treatment_summary,cross_encoder,drug_kb,drug_name_index=None):
+    # Resolve the treatment agents of the patient to drug records once, shared by every SCP section
+    
+    # extract the names of agents used in completed treatments
+    completed_treatment_agents = extract_completed_treatment_agents(treatment_summary)
+    # extract the names of agents used in ongoing treatments
+    ongoing_treatment_agents = extract_ongoing_treatment_agents(treatment_summary)
+    
+    # get set of all agents used in treatment
+    all_agents = set(completed_treatment_agents + ongoing_treatment_agents)
+    
+    # obvious matches (drug, generic or brand name) are resolved by the lexical index of the drug knowledge base
+    drug_scores = {}
+    for agent in all_agents:
+        drug_scores[agent] = drug_kb.lookup(agent)
+    # the remaining agents are matched to the top matching drug name with the cross encoder
+    unmatched_agents = [agent for agent in all_agents if drug_scores[agent] is None]
+    if len(unmatched_agents) > 0:
+        drug_scores.update(match_agents_to_drugs(unmatched_agents,cross_encoder,drug_kb.drug_names_list,drug_name_index))
+        
+    print('Extracted agents and their corresponding drugs:')
+    print(drug_scores)
+    
+    # get the drug information for each drug
+    drug_matches = {}
+    drug_info = ''
+    for agent, drug in drug_scores.items():
+        drug_matches[agent] = drug_kb.get(drug)
+        drug_info += drug_kb.get_drug_info(drug)
+        
+    return drug_matches, drug_info
+
+
 def convert_retrieved_context_to_json(retrieved_context):
     # convert the retrieved context to json
     retrieved_context_json = {}
@@ -72,6 +144,9 @@ def save_scps(patient_folder,care_prompt, retrieved_context, drug_info,care_plan
     with open(os.path.join(patient_folder, f'{task}.txt'), 'w') as f:
         f.write(care_plan)
     # convert the SCP to json
+    if '{' not in str(care_plan) or '}' not in str(care_plan):
+        print(f'No JSON object in the response for {task}, only the text is saved')
+        return
     care_plan = str(care_plan).split('{', 1)[1].strip()
     care_plan = '{'+ care_plan.rsplit('}', 1)[0].strip() + '}'
     try:
@@ -84,48 +159,9 @@ def save_scps(patient_folder,care_prompt, retrieved_context, drug_info,care_plan
         print(f'Error in saving cancer_surveillance as json for patient')
 
 
-def generate_cancer_surveillance_plans(treatment_summary,treatment_summary_compressed,cancer_test_retriever,cross_encoder,drug_names_list,drug_info_path):
+def generate_cancer_surveillance_plans(treatment_summary,treatment_summary_compressed,cancer_test_retriever,drug_info):
     # Function to generate cancer surveillance plans for the patient
 
-    # extract the names of agents used in completed treatments
-    completed_treatment_agents = extract_completed_treatment_agents(treatment_summary)
-    # extract the names of agents used in ongoing treatments
-    ongoing_treatment_agents = extract_ongoing_treatment_agents(treatment_summary)
-    
-    # get set of all agents used in treatment
-    all_agents = set(completed_treatment_agents + ongoing_treatment_agents)
-    
-    # for each drug in all agent, get cross_encoder score with each drug name in drug_names_list, then select the top matching drug
-    drug_scores = {}
-    for agent in all_agents:
-        drug_scores[agent] = {}
-        #create a batch of cross_encoder inputs
-        cross_encoder_input = []
-        cross_encoder_input = [[agent,drug_name] for drug_name in drug_names_list]
-        #get cross_encoder scores
-        scores = cross_encoder.predict(cross_encoder_input)
-        # get the top matching drug
-        top_score_index = np.argmax(scores)
-        top_matching_drug = drug_names_list[top_score_index]
-        drug_scores[agent] = top_matching_drug
-        
-    print('Extracted agents and their corresponding drugs:')
-    print(drug_scores)
-    
-    # get the drug information for each drug
-    drug_info = ''
-    for agent, drug in drug_scores.items():
-        drug_info_file = os.path.join(drug_info_path,drug+'.json')
-        with open(drug_info_file) as f:
-            drug_data= json.load(f)
-            # print(drug_data)
-            f.close()
-        
-        
-        drug_info += f'\nDrug: {drug}\n'
-        drug_info += 'Description: '+ drug_data["description"]#+ '\n'
-        drug_info += 'Side Effects: ' +drug_data['side_effects']#+ '\n'
-        drug_info += 'What to monitor during intake: '+ drug_data['monitoring'] + '\n'
         
 
     
@@ -436,49 +472,10 @@ For each recommendation, provide the following information:
 
 #### for Possible late and long-term effects of cancer treatment  #####
 
-def generate_treatment_effects(treatment_summary,treatment_summary_compressed,treatment_effects_retriever,cross_encoder,drug_names_list,drug_info_path):
+def generate_treatment_effects(treatment_summary,treatment_summary_compressed,treatment_effects_retriever,drug_info):
     # Function to generate possible late and long-term effects of cancer treatment
 
     
-    # extract the names of agents used in completed treatments
-    completed_treatment_agents = extract_completed_treatment_agents(treatment_summary)
-    # extract the names of agents used in ongoing treatments
-    ongoing_treatment_agents = extract_ongoing_treatment_agents(treatment_summary)
-    
-    # get set of all agents used in treatment
-    all_agents = set(completed_treatment_agents + ongoing_treatment_agents)
-    
-    # for each drug in all agent, get cross_encoder score with each drug name in drug_names_list, then select the top matching drug
-    drug_scores = {}
-    for agent in all_agents:
-        drug_scores[agent] = {}
-        #create a batch of cross_encoder inputs
-        cross_encoder_input = []
-        cross_encoder_input = [[agent,drug_name] for drug_name in drug_names_list]
-        #get cross_encoder scores
-        scores = cross_encoder.predict(cross_encoder_input)
-        # get the top matching drug
-        top_score_index = np.argmax(scores)
-        top_matching_drug = drug_names_list[top_score_index]
-        drug_scores[agent] = top_matching_drug
-        
-    print('Extracted agents and their corresponding drugs:')
-    print(drug_scores)
-    
-    # get the drug information for each drug
-    drug_info = ''
-    for agent, drug in drug_scores.items():
-        drug_info_file = os.path.join(drug_info_path,drug+'.json')
-        with open(drug_info_file) as f:
-            drug_data= json.load(f)
-            # print(drug_data)
-            f.close()
-        
-        
-        drug_info += f'\nDrug: {drug}\n'
-        drug_info += 'Description: '+ drug_data["description"]#+ '\n'
-        drug_info += 'Side Effects: ' +drug_data['side_effects']#+ '\n'
-        drug_info += 'What to monitor during intake: '+ drug_data['monitoring'] + '\n'
         
 
     ### What are the already experienced symptons and which drugs might have caused it
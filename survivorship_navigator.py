@@ -10,18 +10,24 @@ from dotenv import load_dotenv
 from llama_index.core import Settings
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.llms.azure_openai import AzureOpenAI
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.postprocessor.colbert_rerank import ColbertRerank
 from sentence_transformers import CrossEncoder
 
 from models.openai_azure import azure_open_ai_call, load_env_vars, hugging_face_models
+from models.embedding_models import get_embedding_model
+from models.llm_cache import enable_llm_response_cache
 from prompts.treatment_summarizer_prompts import treatment_extractor_prompt
 from scp_utils.utils import treatment_summary_for_SCP
-from scp_utils.scp_utils import create_KB_retriever, generate_cancer_surveillance_plans,save_scps, generate_other_issues
+from scp_utils.parallel_utils import run_tasks_in_parallel
+from scp_utils.drug_matching import DrugNameIndex, get_drug_name_index_path
+from scp_utils.drug_kb import DrugKB
+from scp_utils.kb_store import build_unified_kb, get_unified_kb_path, is_unified_kb_current, has_colbert_tokens, ColbertTokenStore
+from scp_utils.query_embedding import QueryEmbeddingBatcher
+from scp_utils.rerankers import get_section_rerankers, ColbertReranker
+from scp_utils.scp_utils import create_KB_retriever, generate_cancer_surveillance_plans,save_scps, generate_other_issues, resolve_patient_drugs
 from scp_utils.scp_utils import generate_treatment_effects, generate_helpful_resources, generate_lifestyle_recommend
 
 
-def treatment_summarizer(patient_note_text,llm_model,temperature=0.0,use_jsonified_patient_data=True):
+def treatment_summarizer(patient_note_text,llm_model,temperature=0.0,use_jsonified_patient_data=True,max_workers=12):
     
     # load the environment variables
     config = load_env_vars()
@@ -29,8 +35,8 @@ def treatment_summarizer(patient_note_text,llm_model,temperature=0.0,use_jsonifi
     if 'gpt' in llm_model.lower():
         config['AZURE_OPENAI_DEPLOYMENT'] = llm_model
     if 'gpt' not in llm_model.lower():
-        hf_model = hugging_face_models(model_name_or_path=llm_model,temperature=temperature,max_tokens=2048,device='cuda')
         temperature = 0.01 # for hugging face models, temperature is set to 0.01
+        hf_model = hugging_face_models(model_name_or_path=llm_model,temperature=temperature,max_tokens=2048,device='cuda')
         
     task_list = [
         'diagnosis',
@@ -59,36 +65,109 @@ def treatment_summarizer(patient_note_text,llm_model,temperature=0.0,use_jsonifi
             patient_note_text = hf_model.generate_response(task_prompt=jsonify_prompt)
             
     
-    treatment_summary_dict = {}
+    # all extraction prompts only depend on the patient note, so they can be issued concurrently
+    task_prompts = {}
     for task_name in task_list:
         task_prompt = prompt_obj.get_prompt(task_name)
-        task_prompt = task_prompt.replace('[PATIENT_DATA]',patient_note_text)
-                
-        if 'gpt' in llm_model.lower():
-            response = azure_open_ai_call(config = config,
-                                    prompt=task_prompt,
-                                    temperature=temperature)
-        else:
-            response = hf_model.generate_response(task_prompt=task_prompt)
-            
-        treatment_summary_dict[task_name] = response
+        task_prompts[task_name] = task_prompt.replace('[PATIENT_DATA]',patient_note_text)
         
     # extract additional comments
     task_prompt = prompt_obj.get_additional_comments_prompt()
-    task_prompt = task_prompt.replace('[PATIENT_DATA]',patient_note_text)
+    task_prompts['additional_comments'] = task_prompt.replace('[PATIENT_DATA]',patient_note_text)
     
-    if 'gpt' in llm_model.lower():
-        response = azure_open_ai_call(config = config,
-                                    prompt=task_prompt,
-                                    temperature=temperature)
-    else:
-        response = hf_model.generate_response(task_prompt=task_prompt)
-        
-    treatment_summary_dict['additional_comments'] = response
+    if 'gpt' not in llm_model.lower():
+        # local model: run all the prompts through the pipeline in padded batches
+        responses = hf_model.generate_batch(list(task_prompts.values()))
+        return dict(zip(task_prompts.keys(), responses))
+    
+    def make_task(task_prompt):
+        return lambda: azure_open_ai_call(config = config,
+                                        prompt=task_prompt,
+                                        temperature=temperature)
+    
+    # a failed task returns '' which is parsed to the default (unknown) entry downstream
+    treatment_summary_dict = run_tasks_in_parallel({task_name: make_task(task_prompt) for task_name, task_prompt in task_prompts.items()},
+                                                   max_workers=max_workers,
+                                                   default='')
     
     return treatment_summary_dict
 
 
+# knowledge base categories used by the SCP sections
+SCP_KB_CATEGORIES = ['Cancer surveillance and other recommended tests for cancer monitoring',
+                     'Possible late and long-term effects of cancer treatment',
+                     'Possible other issues that cancer survivors may experience',
+                     'Lifestyle and behavior recommendations for cancer survivors',
+                     'References to helpful resources for cancer survivors']
+
+
+def load_scp_resources(drug_info_kb_path,
+                       scp_task_kb_path,
+                       reranker,
+                       top_KB_k=30,
+                       device='cuda',
+                       use_unified_kb=False,
+                       query_embedding_batch_size=16,
+                       rerank_top_n=20,
+                       use_bm25=True):
+    # load the knowledge bases, retrievers and the drug matching cross encoder once so they can be shared across patients
+    # with use_unified_kb, all categories are searched in one KB (built on first use) with a filter per section
+    # reranker: 'none', 'cross-encoder' or 'colbert' (or a reranker object) for all sections, or a dict with one per section category
+    # use_bm25 fuses the dense retrieval with BM25 over the node text and keywords for KBs with a BM25 index
+    print('Loading the knowledge bases...')
+    # drug info, all records are loaded into memory once
+    drug_kb = DrugKB(drug_info_kb_path)
+    drug_names_list = drug_kb.drug_names_list
+    print(f'Number of drug names: {len(drug_names_list)}')
+    # cross encoder for drug matching
+    cross_encoder = CrossEncoder(model_name='cross-encoder/ms-marco-MiniLM-L-12-v2', device=device)
+    # embedding index over the drug names, the cross encoder only reranks its shortlist
+    drug_name_index = DrugNameIndex(drug_names_list, get_drug_name_index_path(drug_info_kb_path), device=device)
+    
+    
+    # the queries of concurrently retrieved sections (and patients) are embedded in batched requests
+    query_embedder = QueryEmbeddingBatcher(max_batch_size=query_embedding_batch_size)
+    
+    # sections with the same reranker share one instance, so their candidates are reranked in one batch
+    section_rerankers = get_section_rerankers(reranker, SCP_KB_CATEGORIES, top_n=rerank_top_n, device=device)
+    
+    # create retriever for each knowledge base
+    if use_unified_kb:
+        unified_kb_path = get_unified_kb_path(scp_task_kb_path)
+        # rebuilt whenever a category KB was rebuilt or updated since the unified KB was built
+        if not is_unified_kb_current(scp_task_kb_path, SCP_KB_CATEGORIES, unified_kb_path):
+            print('Building the unified KB...')
+            build_unified_kb(scp_task_kb_path, SCP_KB_CATEGORIES, unified_kb_path)
+        def category_retriever(category):
+            return create_KB_retriever(unified_kb_path,section_rerankers[category],top_KB_k,information_category=category,query_embedder=query_embedder,use_bm25=use_bm25)
+    else:
+        def category_retriever(category):
+            return create_KB_retriever(os.path.join(scp_task_kb_path,category),section_rerankers[category],top_KB_k,query_embedder=query_embedder,use_bm25=use_bm25)
+    
+    # precomputed ColBERT token embeddings of the KB nodes, so that only the queries are encoded when reranking
+    kb_paths = [unified_kb_path] if use_unified_kb else [os.path.join(scp_task_kb_path,category) for category in SCP_KB_CATEGORIES]
+    for section_reranker in set(section_rerankers.values()):
+        if isinstance(section_reranker, ColbertReranker):
+            for kb_path in kb_paths:
+                if has_colbert_tokens(kb_path):
+                    section_reranker.add_token_store(ColbertTokenStore(kb_path))
+    
+    scp_resources = {
+        'drug_info_kb_path': drug_info_kb_path,
+        'drug_kb': drug_kb,
+        'cross_encoder': cross_encoder,
+        'drug_name_index': drug_name_index,
+        'query_embedder': query_embedder,
+        'cancer_test_retriever': category_retriever('Cancer surveillance and other recommended tests for cancer monitoring'),
+        'treatment_effects_retriever': category_retriever('Possible late and long-term effects of cancer treatment'),
+        'other_issues_retriever': category_retriever('Possible other issues that cancer survivors may experience'),
+        'lifestyle_retriever': category_retriever('Lifestyle and behavior recommendations for cancer survivors'),
+        'helpful_resources_retriever': category_retriever('References to helpful resources for cancer survivors'),
+    }
+    
+    return scp_resources
+
+
 def generate_SCP(patient_treatment_info,
                  drug_info_kb_path,
                  scp_task_kb_path,
@@ -97,34 +176,32 @@ def generate_SCP(patient_treatment_info,
                  reranker,
                  is_save=True,
                  save_path='./scp_results',
-                 device='cuda'):
+                 device='cuda',
+                 max_workers=6,
+                 scp_resources=None,
+                 use_unified_kb=False):
     
     # load the environment variables
     config = load_env_vars()
     config['AZURE_OPENAI_DEPLOYMENT'] = llm_model
     if 'gpt' not in llm_model:
-        hf_model = hugging_face_models(model_name_or_path=llm_model,temperature=temperature,max_tokens=2048,device='cuda')
         temperature = 0.01 # for hugging face models, temperature is set to 0.01
+        hf_model = hugging_face_models(model_name_or_path=llm_model,temperature=temperature,max_tokens=2048,device=device)
     
     # retrieval parameters
     top_KB_k = 30
     
     ############# Load the knowledge bases ################
-    print('Loading the knowledge bases...')
-    # drug info
-    drug_names_list = os.listdir(drug_info_kb_path)
-    drug_names_list = [i.split('.json')[0] for i in drug_names_list]
-    print(f'Number of drug names: {len(drug_names_list)}')
-    # cross encoder for drug matching
-    cross_encoder = CrossEncoder(model_name='cross-encoder/ms-marco-MiniLM-L-12-v2', device=device)
-    
-    
-    # create retriever for each knowledge base
-    cancer_test_retriever = create_KB_retriever(os.path.join(scp_task_kb_path,'Cancer surveillance and other recommended tests for cancer monitoring'),reranker,top_KB_k)
-    treatment_effects_retriever = create_KB_retriever(os.path.join(scp_task_kb_path,'Possible late and long-term effects of cancer treatment'),reranker,top_KB_k)
-    other_issues_retriever = create_KB_retriever(os.path.join(scp_task_kb_path,'Possible other issues that cancer survivors may experience'),reranker,top_KB_k)
-    lifestyle_retriever = create_KB_retriever(os.path.join(scp_task_kb_path,'Lifestyle and behavior recommendations for cancer survivors'),reranker,top_KB_k)
-    helpful_resources_retriever = create_KB_retriever(os.path.join(scp_task_kb_path,'References to helpful resources for cancer survivors'),reranker,top_KB_k)
+    if scp_resources is None:
+        scp_resources = load_scp_resources(drug_info_kb_path, scp_task_kb_path, reranker, top_KB_k=top_KB_k, device=device, use_unified_kb=use_unified_kb)
+    drug_kb = scp_resources['drug_kb']
+    cross_encoder = scp_resources['cross_encoder']
+    drug_name_index = scp_resources['drug_name_index']
+    cancer_test_retriever = scp_resources['cancer_test_retriever']
+    treatment_effects_retriever = scp_resources['treatment_effects_retriever']
+    other_issues_retriever = scp_resources['other_issues_retriever']
+    lifestyle_retriever = scp_resources['lifestyle_retriever']
+    helpful_resources_retriever = scp_resources['helpful_resources_retriever']
     
 
     treatment_summary_json = treatment_summary_for_SCP(patient_treatment_info)
@@ -139,12 +216,27 @@ Compress the treatment summary to best describe the patient's treatment history.
 """
     care_prompt = care_prompt.replace('[TREATMENT_SUMMARY]', str(treatment_summary_json))
     
-    if 'gpt' in llm_model.lower():
-        treatment_summary_compressed = azure_open_ai_call(config = config,
-                                    prompt=care_prompt,
-                                    temperature=0.2)
+    def llm_call(prompt, temperature=0.2):
+        if 'gpt' in llm_model.lower():
+            return azure_open_ai_call(config = config, prompt = prompt, temperature=temperature)
+        return hf_model.generate_response(task_prompt=prompt)
+    
+    # the agent-to-drug resolution does not depend on the compressed summary, so it runs alongside the LLM call
+    # and its result is shared by every SCP section
+    compress_results = run_tasks_in_parallel({
+        'treatment_summary_compressed': lambda: llm_call(care_prompt),
+        'drug_resolution': lambda: resolve_patient_drugs(treatment_summary = treatment_summary_json,
+                                                         cross_encoder = cross_encoder,
+                                                         drug_kb = drug_kb,
+                                                         drug_name_index = drug_name_index),
+    }, max_workers=max_workers)
+    treatment_summary_compressed = compress_results['treatment_summary_compressed']
+    if treatment_summary_compressed is None:
+        raise RuntimeError('Compressing the treatment summary failed.')
+    if compress_results['drug_resolution'] is None:
+        drug_matches, drug_info = {}, '' # drug matching failed, the sections are generated without drug information
     else:
-        treatment_summary_compressed = hf_model.generate_response(task_prompt=care_prompt)
+        drug_matches, drug_info = compress_results['drug_resolution']
     
     ##### Generate SCPs #####
     # 1. Cancer surveillance and other recommended tests for cancer monitoring
@@ -152,150 +244,112 @@ Compress the treatment summary to best describe the patient's treatment history.
     # 3. Possible other issues that cancer survivors may experience
     # 4. Lifestyle and behavior recommendations for cancer survivors
     # 5. References to helpful resources for cancer survivors
-    SCP_JSON = {}
-    print('Recommending cancer surveillance plans...')
-    care_prompt, retrieved_context, drug_info = generate_cancer_surveillance_plans(treatment_summary = treatment_summary_json,
-                                                                                treatment_summary_compressed = treatment_summary_compressed,
-                                                                                cancer_test_retriever = cancer_test_retriever,
-                                                                                cross_encoder = cross_encoder,
-                                                                                drug_names_list = drug_names_list,
-                                                                                drug_info_path = drug_info_kb_path)
-
-    if 'gpt' in llm_model.lower():
-        response = azure_open_ai_call(config = config,
-                                    prompt=care_prompt,
-                                    temperature=0.2)
-    else:
-        response = hf_model.generate_response(task_prompt=care_prompt)
-    
-    SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring'] = {}
-    SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring']['care_prompt'] = care_prompt
-    SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring']['retrieved_context'] = retrieved_context
-    SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring']['drug_info'] = drug_info
-    SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring']['care_plan'] = response
-    
-    # save the scp
-    if is_save:  
-        save_scps(patient_folder = save_path,
-              care_prompt = care_prompt,
-              retrieved_context = retrieved_context,
-              drug_info = drug_info,
-              care_plan = response,
-              task = 'Cancer surveillance and other recommended tests for cancer monitoring',
-              )
-    
-    print('Recommending possible late and long-term effects of cancer treatment...')
-    
-    care_prompt, retrieved_context, drug_info, care_prompt_already_experienced = generate_treatment_effects(treatment_summary = treatment_summary_json,
-                                                                                                                    treatment_summary_compressed = treatment_summary_compressed,
-                                                                                                                    treatment_effects_retriever = treatment_effects_retriever,
-                                                                                                                    cross_encoder = cross_encoder,
-                                                                                                                    drug_names_list = drug_names_list,
-                                                                                                                    drug_info_path = drug_info_kb_path)
-    
-    if 'gpt' in llm_model.lower():
-        response1 = azure_open_ai_call(config = config, prompt = care_prompt_already_experienced,temperature=0.2)
-        response2 = azure_open_ai_call(config = config, prompt = care_prompt,temperature=0.2)
-    else:
-        response1 = hf_model.generate_response(task_prompt=care_prompt_already_experienced)
-        response2 = hf_model.generate_response(task_prompt=care_prompt)
-    
-    SCP_JSON['Already experienced symptoms or side effects of the patient and which drugs might have caused it?'] = response1
-    SCP_JSON['Possible late and long-term effects of cancer treatment'] = {}
-    SCP_JSON['Possible late and long-term effects of cancer treatment']['care_prompt'] = care_prompt
-    SCP_JSON['Possible late and long-term effects of cancer treatment']['retrieved_context'] = retrieved_context
-    SCP_JSON['Possible late and long-term effects of cancer treatment']['drug_info'] = drug_info
-    SCP_JSON['Possible late and long-term effects of cancer treatment']['care_plan'] = response2
-    
-    #save response1
-    if is_save:
-        response1 = {'Already experienced symptoms or side effects of the patient and which drugs might have caused it?' : response1}
-        with open(os.path.join(save_path, f'Already experienced symptoms or side effects.json'), 'w') as f:
-            json.dump(response1, f)
-    
-    if is_save:  
-        save_scps(patient_folder = save_path,
-              care_prompt = care_prompt,
-              retrieved_context = retrieved_context,
-              drug_info = drug_info,
-              care_plan = response2,
-              task = 'Possible late and long-term effects of cancer treatment',
-              )
-    
-    print('Suggestions for other issues that cancer survivors may experience...')
-    care_prompt, retrieved_context = generate_other_issues(treatment_summary = treatment_summary_json,
-                                                        treatment_summary_compressed = treatment_summary_compressed,
-                                                        other_issues_retriever = other_issues_retriever)
-    
-    if 'gpt' in llm_model.lower():
-        response = azure_open_ai_call(config = config, prompt = care_prompt,temperature=0.2)
-    else:
-        response = hf_model.generate_response(task_prompt=care_prompt)
-        
-    SCP_JSON['Possible other issues that cancer survivors may experience'] = {}
-    SCP_JSON['Possible other issues that cancer survivors may experience']['care_prompt'] = care_prompt
-    SCP_JSON['Possible other issues that cancer survivors may experience']['retrieved_context'] = retrieved_context
-    SCP_JSON['Possible other issues that cancer survivors may experience']['drug_info'] = ''
-    SCP_JSON['Possible other issues that cancer survivors may experience']['care_plan'] = response
-    
-    if is_save:  
-        save_scps(patient_folder = save_path,
-              care_prompt = care_prompt,
-              retrieved_context = retrieved_context,
-              drug_info = '',
-              care_plan = response,
-              task = 'Possible other issues that cancer survivors may experience',
-              )
-    
-    print('Lifestyle and behavior recommendations for cancer survivors...')
-    care_prompt, retrieved_context = generate_lifestyle_recommend(treatment_summary = treatment_summary_json,
-                                                                    treatment_summary_compressed = treatment_summary_compressed,
-                                                                    lifestyle_retriever = lifestyle_retriever)
-    
-    if 'gpt' in llm_model.lower():
-        response = azure_open_ai_call(config = config, prompt = care_prompt,temperature=0.2)
-    else:
-        response = hf_model.generate_response(task_prompt=care_prompt)
-    
-    SCP_JSON['Lifestyle and behavior recommendations for cancer survivors'] = {}
-    SCP_JSON['Lifestyle and behavior recommendations for cancer survivors']['care_prompt'] = care_prompt
-    SCP_JSON['Lifestyle and behavior recommendations for cancer survivors']['retrieved_context'] = retrieved_context
-    SCP_JSON['Lifestyle and behavior recommendations for cancer survivors']['drug_info'] = ''
-    SCP_JSON['Lifestyle and behavior recommendations for cancer survivors']['care_plan'] = response
-    
-    if is_save:  
-        save_scps(patient_folder = save_path,
-              care_prompt = care_prompt,
-              retrieved_context = retrieved_context,
-              drug_info = '',
-              care_plan = response,
-              task = 'Lifestyle and behavior recommendations for cancer survivors',
-              )
-    
-    print('References to helpful resources for cancer survivors...')
-    care_prompt, retrieved_context = generate_helpful_resources(treatment_summary = treatment_summary_json,
+    # Once the compressed summary exists the sections are independent, so retrieval and generation
+    # for every section run concurrently and the results are written below in a fixed order.
+    # Each builder retrieves the context and returns the prompts that still need an LLM response.
+    def build_cancer_surveillance():
+        print('Recommending cancer surveillance plans...')
+        # unpacked into section_drug_info, assigning drug_info here would make it local to the builder
+        care_prompt, retrieved_context, section_drug_info = generate_cancer_surveillance_plans(treatment_summary = treatment_summary_json,
+                                                                                            treatment_summary_compressed = treatment_summary_compressed,
+                                                                                            cancer_test_retriever = cancer_test_retriever,
+                                                                                            drug_info = drug_info)
+        return {'care_prompt': care_prompt, 'retrieved_context': retrieved_context, 'drug_info': section_drug_info,
+                'llm_prompts': {'care_plan': care_prompt}}
+    
+    def build_treatment_effects():
+        print('Recommending possible late and long-term effects of cancer treatment...')
+        care_prompt, retrieved_context, section_drug_info, care_prompt_already_experienced = generate_treatment_effects(treatment_summary = treatment_summary_json,
+                                                                                                                                treatment_summary_compressed = treatment_summary_compressed,
+                                                                                                                                treatment_effects_retriever = treatment_effects_retriever,
+                                                                                                                                drug_info = drug_info)
+        return {'care_prompt': care_prompt, 'retrieved_context': retrieved_context, 'drug_info': section_drug_info,
+                'llm_prompts': {'already_experienced': care_prompt_already_experienced, 'care_plan': care_prompt}}
+    
+    def build_other_issues():
+        print('Suggestions for other issues that cancer survivors may experience...')
+        care_prompt, retrieved_context = generate_other_issues(treatment_summary = treatment_summary_json,
+                                                            treatment_summary_compressed = treatment_summary_compressed,
+                                                            other_issues_retriever = other_issues_retriever)
+        return {'care_prompt': care_prompt, 'retrieved_context': retrieved_context, 'drug_info': '',
+                'llm_prompts': {'care_plan': care_prompt}}
+    
+    def build_lifestyle():
+        print('Lifestyle and behavior recommendations for cancer survivors...')
+        care_prompt, retrieved_context = generate_lifestyle_recommend(treatment_summary = treatment_summary_json,
                                                                         treatment_summary_compressed = treatment_summary_compressed,
-                                                                        helpful_resources_retriever = helpful_resources_retriever)
+                                                                        lifestyle_retriever = lifestyle_retriever)
+        return {'care_prompt': care_prompt, 'retrieved_context': retrieved_context, 'drug_info': '',
+                'llm_prompts': {'care_plan': care_prompt}}
+    
+    def build_helpful_resources():
+        print('References to helpful resources for cancer survivors...')
+        care_prompt, retrieved_context = generate_helpful_resources(treatment_summary = treatment_summary_json,
+                                                                            treatment_summary_compressed = treatment_summary_compressed,
+                                                                            helpful_resources_retriever = helpful_resources_retriever)
+        return {'care_prompt': care_prompt, 'retrieved_context': retrieved_context, 'drug_info': '',
+                'llm_prompts': {'care_plan': care_prompt}}
+    
+    section_builders = {
+        'Cancer surveillance and other recommended tests for cancer monitoring': build_cancer_surveillance,
+        'Possible late and long-term effects of cancer treatment': build_treatment_effects,
+        'Possible other issues that cancer survivors may experience': build_other_issues,
+        'Lifestyle and behavior recommendations for cancer survivors': build_lifestyle,
+        'References to helpful resources for cancer survivors': build_helpful_resources,
+    }
+    
+    def generate_section(build_section):
+        section = build_section()
+        responses = run_tasks_in_parallel({key: (lambda prompt=prompt: llm_call(prompt)) for key, prompt in section['llm_prompts'].items()},
+                                          max_workers=max_workers)
+        failed = [key for key, response in responses.items() if response is None]
+        if len(failed) > 0:
+            # the section is reported as failed and skipped below, instead of being saved with an empty care plan
+            raise RuntimeError(f'No LLM response for {failed}')
+        section.update(responses)
+        return section
     
     if 'gpt' in llm_model.lower():
-        response = azure_open_ai_call(config = config, prompt = care_prompt,temperature=0.2)
+        section_results = run_tasks_in_parallel({task: (lambda build_section=build_section: generate_section(build_section)) for task, build_section in section_builders.items()},
+                                                max_workers=max_workers)
     else:
-        response = hf_model.generate_response(task_prompt=care_prompt)
-    
-    SCP_JSON['References to helpful resources for cancer survivors'] = {}
-    SCP_JSON['References to helpful resources for cancer survivors']['care_prompt'] = care_prompt
-    SCP_JSON['References to helpful resources for cancer survivors']['retrieved_context'] = retrieved_context
-    SCP_JSON['References to helpful resources for cancer survivors']['drug_info'] = ''
-    SCP_JSON['References to helpful resources for cancer survivors']['care_plan'] = response
-    
-    if is_save:  
-        save_scps(patient_folder = save_path,
-                care_prompt = care_prompt,
-                retrieved_context = retrieved_context,
-                drug_info = '',
-                care_plan = response,
-                task = 'References to helpful resources for cancer survivors',
-                )
+        # local model: retrieve the context for every section first, then generate all care plans in padded batches
+        section_results = run_tasks_in_parallel(section_builders, max_workers=max_workers)
+        batch_keys = [(task, key) for task, section in section_results.items() if section is not None for key in section['llm_prompts']]
+        responses = hf_model.generate_batch([section_results[task]['llm_prompts'][key] for task, key in batch_keys])
+        for (task, key), response in zip(batch_keys, responses):
+            section_results[task][key] = response
+    
+    # collect the sections and save them in a fixed order
+    SCP_JSON = {}
+    for task, section in section_results.items():
+        if section is None:
+            print(f'Skipping section: {task}')
+            continue
+        
+        if task == 'Possible late and long-term effects of cancer treatment':
+            SCP_JSON['Already experienced symptoms or side effects of the patient and which drugs might have caused it?'] = section['already_experienced']
+            #save response1
+            if is_save:
+                response1 = {'Already experienced symptoms or side effects of the patient and which drugs might have caused it?' : section['already_experienced']}
+                with open(os.path.join(save_path, f'Already experienced symptoms or side effects.json'), 'w') as f:
+                    json.dump(response1, f)
+        
+        SCP_JSON[task] = {}
+        SCP_JSON[task]['care_prompt'] = section['care_prompt']
+        SCP_JSON[task]['retrieved_context'] = section['retrieved_context']
+        SCP_JSON[task]['drug_info'] = section['drug_info']
+        SCP_JSON[task]['care_plan'] = section['care_plan']
+        
+        # save the scp
+        if is_save:  
+            save_scps(patient_folder = save_path,
+                  care_prompt = section['care_prompt'],
+                  retrieved_context = section['retrieved_context'],
+                  drug_info = section['drug_info'],
+                  care_plan = section['care_plan'],
+                  task = task,
+                  )
     
     print('SCP Generation Done!')
     
@@ -333,6 +387,9 @@ Compress the treatment summary to best describe the patient's treatment history.
         # save the treatment summary
         with open(os.path.join(save_path, f'treatment_summary.json'), 'w') as f:
             json.dump(treatment_summary_json, f)
+        # save the drugs matched to the treatment agents
+        with open(os.path.join(save_path, f'drug_matches.json'), 'w') as f:
+            json.dump({agent: drug_data['drug_name'] for agent, drug_data in drug_matches.items()}, f)
             
     return treatment_summary_json,SCP_JSON
 
@@ -345,32 +402,25 @@ if __name__ == '__main__':
     llm_model = 'gpt-4o'
     is_save = True
     use_jsonified_patient_data = True
+    llm_cache_path = None # e.g. './llm_cache/llm_responses.sqlite' for a persistent cache of the temperature 0 LLM responses
+    use_unified_kb = False # search all categories in one KB with a filter per section instead of one KB per category
+    embedding_provider = 'azure' # 'azure' (text-embedding-3-large) or 'local' (sentence-transformers), must match the provider scp_task_kb_path was built with
+    
+    if llm_cache_path is not None:
+        llm_cache = enable_llm_response_cache(db_path=llm_cache_path, max_size_mb=1024)
     
     if not os.path.exists(save_path):
         os.makedirs(save_path)
     
     load_dotenv()
-    api_key = os.getenv('AZURE_OPENAI_API_KEY')
-    azure_endpoint = os.getenv('OPENAI_API_BASE')
-    api_version = os.getenv('OPENAI_API_VERSION')
     device = 'cuda'
     
-    embedding_model = AzureOpenAIEmbedding(
-                        model='text-embedding-3-large',
-                        deployment_name='text-embedding-3-large',
-                        api_key=api_key,
-                        azure_endpoint=azure_endpoint,
-                        api_version=api_version,
-                    )
+    embedding_model = get_embedding_model(embedding_provider)
     Settings.embed_model = embedding_model
     
-    # reranker model
-    reranker = ColbertRerank(
-                top_n=20,
-                model="colbert-ir/colbertv2.0",
-                tokenizer="colbert-ir/colbertv2.0",
-                keep_retrieval_score=True,
-                )
+    # reranker of the retrieved guideline context (top 20 of the top_KB_k candidates): 'none', 'cross-encoder' or 'colbert',
+    # or a dict with one of them per section category, e.g. {'References to helpful resources for cancer survivors': 'none', ...}
+    reranker = 'colbert'
     
     
     treatment_summary_dict = treatment_summarizer(patient_note_text,llm_model,use_jsonified_patient_data=use_jsonified_patient_data) # sometimes use_jsonified_patient_data=False is better for large OpenAI models
@@ -383,4 +433,8 @@ if __name__ == '__main__':
                                                     reranker = reranker,
                                                     is_save = is_save,
                                                     save_path = save_path,
-                                                    device = device)
\ No newline at end of file
+                                                    device = device,
+                                                    use_unified_kb = use_unified_kb)
+    
+    if llm_cache_path is not None:
+        print(f'LLM response cache: {llm_cache.stats()}')
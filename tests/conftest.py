@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported from the repository root, as when running the scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+from scp_utils.chunk_filter import ChunkPrefilter
+
+
+def test_short_clinical_lines_are_kept():
+    prefilter = ChunkPrefilter()
+    for text in ['Years 3 to 5: • History and physical every 6-12 months • CT chest, abdomen, and pelvis with contrast every 6-12 months',
+                 'Vitamin D 800 – 1,000 IU/day',
+                 'Abnormal BMD: Osteopenia, T-score between -1.0 and -2.4; Osteoporosis, T-score ≤ -2.5',
+                 'Bone Density Monitoring (DEXA) baseline at 2 years post-op']:
+        assert prefilter.check(text) is None
+
+
+def test_empty_chunks_are_dropped():
+    prefilter = ChunkPrefilter()
+    for text in ['   ', '- 12 -', 'Page 4', '• • •']:
+        assert prefilter.check(text) == 'empty'
+
+
+def test_near_duplicate_chunks_are_dropped():
+    prefilter = ChunkPrefilter()
+    text = ('Survivors of colorectal cancer should have a history and physical examination every 3 to 6 months for the first 2 years '
+            'after treatment and every 6 months for years 3 through 5. CEA testing should be performed every 3 to 6 months.')
+    assert prefilter.check(text) is None
+    assert prefilter.check(text.replace('every 3 to 6 months.', 'every 3 to 6 months')) == 'duplicate'
+
+
+def test_survivorship_resource_list_is_kept():
+    prefilter = ChunkPrefilter()
+    text = ('Resources for cancer survivors\n'
+            'NCI Office of Cancer Survivorship, National Cancer Institute: https://cancercontrol.cancer.gov/ocs\n'
+            'Dana-Farber Cancer Institute Adult Survivorship Program, Boston, MA\n'
+            'MD Anderson Cancer Center Survivorship Clinics, Houston, TX\n'
+            'Memorial Sloan Kettering Cancer Center Survivorship Center, New York, NY\n'
+            'University hospital survivorship clinic contact e-mail: survivorship@example-hospital.org')
+    assert prefilter.check(text) is None
+
+
+def test_author_affiliations_are_dropped():
+    prefilter = ChunkPrefilter()
+    assert prefilter.check('1Department of Medical Oncology, Dana-Farber Cancer Institute, Boston, MA, USA\n'
+                           '2Division of Cancer Medicine, MD Anderson Cancer Center, Houston, TX, USA\n'
+                           '3School of Medicine, University of Washington, Seattle, WA, USA') == 'affiliations'
+    assert prefilter.check('Corresponding author: Jane Doe, MD\n'
+                           'Memorial Sloan Kettering Cancer Center\n'
+                           'E-mail: jdoe@example.org\n'
+                           'Received for publication March 3, 2021') == 'affiliations'
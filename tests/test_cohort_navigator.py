@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+for module in ('pandas', 'torch', 'transformers', 'sentence_transformers', 'llama_index.llms.azure_openai', 'llama_index.embeddings.azure_openai'):
+    pytest.importorskip(module)
+
+import cohort_navigator
+from cohort_navigator import check_patient_id, load_manifest, run_cohort
+from survivorship_navigator import SCP_KB_CATEGORIES
+
+
+@pytest.mark.parametrize('patient_id', ['', '..', '../outside', 'a/b', 'a\\b'])
+def test_invalid_patient_ids_are_rejected(patient_id):
+    with pytest.raises(ValueError):
+        check_patient_id(patient_id)
+
+
+def test_run_cohort_records_partial_and_skips_duplicate_ids(tmp_path, monkeypatch):
+    input_path = tmp_path / 'notes.jsonl'
+    notes = [{'patient_id': 'p1', 'note': 'first'}, {'patient_id': 'p2', 'note': 'second'},
+             {'patient_id': 'p1', 'note': 'duplicate'}, {'patient_id': '../p3', 'note': 'outside'}]
+    input_path.write_text(''.join(json.dumps(note) + '\n' for note in notes))
+
+    processed_notes = []
+    def fake_process_patient(patient_id, patient_note_text, save_path, llm_model, scp_resources, **kwargs):
+        check_patient_id(patient_id)
+        processed_notes.append(patient_note_text)
+        # the SCP of p2 is missing its last section
+        return SCP_KB_CATEGORIES[-1:] if patient_id == 'p2' else []
+    monkeypatch.setattr(cohort_navigator, 'load_scp_resources', lambda *args, **kwargs: {'query_embedder': type('QueryEmbedder', (), {'stats': lambda self: {}})()})
+    monkeypatch.setattr(cohort_navigator, 'process_patient', fake_process_patient)
+
+    save_path = tmp_path / 'scp_results'
+    run_cohort(str(input_path), str(save_path), None, None, 'gpt-4o', None, num_patient_workers=1, device='cpu')
+
+    assert sorted(processed_notes) == ['first', 'second']
+    assert load_manifest(str(save_path / 'manifest.jsonl')) == {'p1': 'done', 'p2': 'partial', '../p3': 'failed'}
@@ -0,0 +1,55 @@
+import os
+import json
+
+import pytest
+
+pytest.importorskip('fitz')
+pytest.importorskip('torch')
+
+from llama_index.core import Settings, StorageContext, load_index_from_storage
+from llama_index.core.embeddings import MockEmbedding
+
+from create_kb import create_and_store_vector_index_for_KB
+from scp_utils.rule_dedup import merge_rule_cluster
+
+
+SOURCE = ('Survivors of colon cancer should have a colonoscopy one year after surgery, and then every five years '
+          'if no advanced adenomas are found. CEA testing every three to six months for five years. ') * 12
+
+
+def rule(text, page_number):
+    return {'text': text,
+            'metadata': {'page_number': page_number, 'doc_title': 'Colon cancer survivorship guideline',
+                         'keywords': ['colonoscopy', 'CEA'], 'information_category': 'Cancer surveillance', 'source': SOURCE}}
+
+
+@pytest.fixture
+def mock_embed_model():
+    # set directly, reading Settings.embed_model before it is set would load the default OpenAI embedding
+    previous_embed_model = Settings._embed_model
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+    yield Settings.embed_model
+    Settings._embed_model = previous_embed_model
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_index_is_built_from_merged_rules(tmp_path, mock_embed_model, incremental):
+    merged_rule = merge_rule_cluster([rule('Colonoscopy one year after surgery, then every five years.', 3),
+                                      rule('Colonoscopy at one year after resection and every five years after.', 7)])
+    knowledge_path = os.path.join(str(tmp_path), 'group_wise_separated_knowledge.json')
+    with open(knowledge_path, 'w') as f:
+        json.dump({'Cancer surveillance': [merged_rule]}, f)
+
+    save_path = os.path.join(str(tmp_path), 'vector_kbs')
+    if incremental:
+        # the added entries of an existing index go through insert_nodes
+        with open(knowledge_path, 'w') as f:
+            json.dump({'Cancer surveillance': [rule('CEA every three to six months for five years.', 4)]}, f)
+        create_and_store_vector_index_for_KB(knowledge_path, save_path)
+        with open(knowledge_path, 'w') as f:
+            json.dump({'Cancer surveillance': [merged_rule]}, f)
+    create_and_store_vector_index_for_KB(knowledge_path, save_path, incremental=incremental)
+
+    index = load_index_from_storage(StorageContext.from_defaults(persist_dir=os.path.join(save_path, 'Cancer surveillance')))
+    assert [node.metadata['merged_sources'] for node in index.docstore.docs.values()] == [[{'doc_title': 'Colon cancer survivorship guideline', 'page_number': 3},
+                                                                                          {'doc_title': 'Colon cancer survivorship guideline', 'page_number': 7}]]
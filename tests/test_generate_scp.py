@@ -0,0 +1,58 @@
+import json
+import types
+
+import pytest
+
+for module in ['pandas', 'torch', 'transformers', 'sentence_transformers', 'llama_index.llms.azure_openai', 'llama_index.embeddings.azure_openai']:
+    pytest.importorskip(module)
+
+import survivorship_navigator
+
+
+class FakeRetriever():
+    def retrieve(self, query_str):
+        return [types.SimpleNamespace(text='History and physical every 3-6 months for 2 years.', metadata={'page_number': 1})]
+
+
+def fake_resources():
+    resources = {'drug_kb': None, 'cross_encoder': None, 'drug_name_index': None, 'query_embedder': None}
+    for name in ['cancer_test_retriever', 'treatment_effects_retriever', 'other_issues_retriever', 'lifestyle_retriever', 'helpful_resources_retriever']:
+        resources[name] = FakeRetriever()
+    return resources
+
+
+@pytest.fixture
+def stubbed_llm(monkeypatch):
+    monkeypatch.setattr(survivorship_navigator, 'load_env_vars', lambda: {})
+    monkeypatch.setattr(survivorship_navigator, 'treatment_summary_for_SCP', lambda info: {'diagnosis': 'colon cancer'})
+    monkeypatch.setattr(survivorship_navigator, 'resolve_patient_drugs', lambda **kwargs: ({}, 'Oxaliplatin: neuropathy.'))
+    monkeypatch.setattr(survivorship_navigator, 'azure_open_ai_call', lambda config, prompt, temperature=0.2: json.dumps({'plan': 'ok'}))
+
+
+def test_generate_scp_returns_all_sections(stubbed_llm, tmp_path):
+    _, SCP_JSON = survivorship_navigator.generate_SCP({}, None, None, 'gpt-4o', None, 'none',
+                                                      save_path=str(tmp_path), scp_resources=fake_resources())
+    for category in survivorship_navigator.SCP_KB_CATEGORIES:
+        assert category in SCP_JSON
+    assert SCP_JSON['Cancer surveillance and other recommended tests for cancer monitoring']['drug_info'] == 'Oxaliplatin: neuropathy.'
+    assert (tmp_path / 'Cancer surveillance and other recommended tests for cancer monitoring.json').exists()
+
+
+def test_generate_scp_skips_section_without_llm_response(stubbed_llm, monkeypatch, tmp_path):
+    def llm_call(config, prompt, temperature=0.2):
+        if 'cancer surveillance' in prompt:
+            raise RuntimeError('LLM call failed')
+        return json.dumps({'plan': 'ok'})
+    monkeypatch.setattr(survivorship_navigator, 'azure_open_ai_call', llm_call)
+
+    _, SCP_JSON = survivorship_navigator.generate_SCP({}, None, None, 'gpt-4o', None, 'none',
+                                                      save_path=str(tmp_path), scp_resources=fake_resources())
+    assert 'Cancer surveillance and other recommended tests for cancer monitoring' not in SCP_JSON
+    assert 'Lifestyle and behavior recommendations for cancer survivors' in SCP_JSON
+
+
+def test_save_scps_keeps_text_without_json(tmp_path):
+    from scp_utils.scp_utils import save_scps
+    save_scps(str(tmp_path), 'prompt', {}, '', 'I cannot help with that.', 'task')
+    assert (tmp_path / 'task.txt').read_text() == 'I cannot help with that.'
+    assert not (tmp_path / 'task.json').exists()
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('fitz')
+pytest.importorskip('openai')
+
+from openai import OpenAI
+from pydantic import BaseModel
+
+from scp_utils.kb_extraction import ExtractionRequestPool
+from scp_utils.batch_extraction import BatchExtraction
+from scp_utils.batch_stub_server import BatchStubServer
+
+
+class Output(BaseModel):
+    info: str
+
+
+def fake_client(contents):
+    # chat client answering the requests with the next of contents
+    contents = list(contents)
+    parse = lambda **kwargs: SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=contents.pop(0)))])
+    return SimpleNamespace(beta=SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=parse))))
+
+
+class FakeCheckpoint():
+    def __init__(self):
+        self.responses = {}
+
+    def append(self, pdf_hash, page_number, chunk_hash, response):
+        self.responses[chunk_hash] = response
+
+
+def test_refused_request_is_not_checkpointed():
+    responses = []
+    with ExtractionRequestPool(fake_client([None, '{"info": "Colonoscopy at one year."}']), Output, max_workers=1) as request_pool:
+        request_pool.submit([{'role': 'user', 'content': 'first'}], on_response=responses.append)
+        request_pool.submit([{'role': 'user', 'content': 'second'}], on_response=responses.append)
+    assert responses == ['{"info": "Colonoscopy at one year."}']
+    assert request_pool.num_failed == 1
+
+
+def test_refused_batch_request_is_not_checkpointed(tmp_path):
+    refused = lambda body: None if body['messages'][-1]['content'] == 'refused' else '{"info": "Colonoscopy at one year."}'
+    server = BatchStubServer(responder=refused, polls_until_complete=0).start()
+    try:
+        batch_extraction = BatchExtraction(OpenAI(api_key='stub', base_url=server.base_url), str(tmp_path), Output, poll_interval_s=0.01)
+        batch_extraction.add([{'role': 'user', 'content': 'refused'}], 'guide', 'pdf-hash', 1, 'chunk-1')
+        batch_extraction.add([{'role': 'user', 'content': 'answered'}], 'guide', 'pdf-hash', 2, 'chunk-2')
+        batch_extraction.submit()
+        checkpoint = FakeCheckpoint()
+        batch_extraction.wait(lambda pdf_file_name: checkpoint)
+    finally:
+        server.stop()
+    assert checkpoint.responses == {'chunk-2': '{"info": "Colonoscopy at one year."}'}
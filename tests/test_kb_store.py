@@ -0,0 +1,57 @@
+import os
+import json
+import zlib
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('llama_index.core')
+
+from llama_index.core.schema import TextNode
+from llama_index.core.storage.docstore.utils import doc_to_json
+
+from scp_utils.kb_store import (EMBEDDINGS_FILE, EMBEDDING_IDS_FILE, DOCSTORE_SQLITE_FILE, _write_node_records,
+                                build_unified_kb, is_unified_kb_current, load_kb_store, KBRetriever)
+
+
+CATEGORIES = ['Category A', 'Category B']
+
+
+def write_category_kb(KB_path, texts):
+    # an exported category KB with one random embedding per text
+    os.makedirs(KB_path, exist_ok=True)
+    nodes = [TextNode(id_=f'{os.path.basename(KB_path)}-{i}', text=text) for i, text in enumerate(texts)]
+    embeddings = np.random.RandomState(len(texts)).rand(len(texts), 8).astype('float32')
+    np.save(os.path.join(KB_path, EMBEDDINGS_FILE), embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True))
+    with open(os.path.join(KB_path, EMBEDDING_IDS_FILE), 'w') as f:
+        json.dump({'ids': [node.node_id for node in nodes], 'embed_model': 'test-model'}, f)
+    _write_node_records(os.path.join(KB_path, DOCSTORE_SQLITE_FILE),
+                        [(node.node_id, zlib.compress(json.dumps(doc_to_json(node)).encode('utf-8'))) for node in nodes])
+
+
+def test_unified_kb_is_rebuilt_when_a_category_changes(tmp_path):
+    scp_task_kb_path = str(tmp_path)
+    write_category_kb(os.path.join(scp_task_kb_path, 'Category A'), ['Colonoscopy at one year after surgery.'])
+    write_category_kb(os.path.join(scp_task_kb_path, 'Category B'), ['Neuropathy after oxaliplatin.'])
+    assert not is_unified_kb_current(scp_task_kb_path, CATEGORIES)
+
+    unified_kb_path = build_unified_kb(scp_task_kb_path, CATEGORIES)
+    assert is_unified_kb_current(scp_task_kb_path, CATEGORIES)
+    assert len(load_kb_store(unified_kb_path).ids) == 2
+
+    # an incremental update of one category makes the unified KB stale
+    write_category_kb(os.path.join(scp_task_kb_path, 'Category B'), ['Neuropathy after oxaliplatin.', 'Cardiotoxicity after anthracyclines.'])
+    assert not is_unified_kb_current(scp_task_kb_path, CATEGORIES)
+
+    build_unified_kb(scp_task_kb_path, CATEGORIES)
+    assert is_unified_kb_current(scp_task_kb_path, CATEGORIES)
+    assert len(load_kb_store(unified_kb_path).ids) == 3
+
+
+def test_kb_retriever_rejects_other_embedding_model(tmp_path):
+    KB_path = os.path.join(str(tmp_path), 'Category A')
+    write_category_kb(KB_path, ['Colonoscopy at one year after surgery.'])
+    KBRetriever(KB_path, embed_model=SimpleNamespace(model_name='test-model'))
+    with pytest.raises(ValueError, match='was embedded with test-model'):
+        KBRetriever(KB_path, embed_model=SimpleNamespace(model_name='text-embedding-3-large'))
@@ -0,0 +1,69 @@
+import json
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+for module in ('torch', 'transformers', 'psutil', 'llama_index.embeddings.azure_openai'):
+    pytest.importorskip(module)
+
+from models import openai_azure
+from models.openai_azure import azure_open_ai_call_async, aclose_azure_openai_clients, close_azure_openai_clients
+
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    # answers every chat completion request with the last message of the request
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps({'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                           'choices': [{'index': 0, 'finish_reason': 'stop',
+                                        'message': {'role': 'assistant', 'content': request['messages'][-1]['content']}}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def config():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ChatCompletionHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield {'OPENAI_API_BASE': f'http://127.0.0.1:{httpd.server_address[1]}', 'OPENAI_API_VERSION': '2024-06-01',
+           'AZURE_OPENAI_API_KEY': 'test', 'AZURE_OPENAI_DEPLOYMENT': 'gpt-4o'}
+    close_azure_openai_clients()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_async_call_in_separate_event_loops(config):
+    clients = []
+    async def call(prompt):
+        response = await azure_open_ai_call_async(config, prompt)
+        clients.extend(client for _, client in openai_azure._azure_openai_async_clients.values())
+        return response
+
+    # each asyncio.run has its own loop and client, which is closed when the loop shuts down
+    assert asyncio.run(call('first')) == 'first'
+    assert asyncio.run(call('second')) == 'second'
+    assert len(clients) == 2 and clients[0] is not clients[1]
+    assert all(client.is_closed() for client in clients)
+    assert openai_azure._azure_openai_async_clients == {}
+
+
+def test_async_clients_are_closed_explicitly(config):
+    async def call():
+        response = await azure_open_ai_call_async(config, 'prompt')
+        clients = [client for _, client in openai_azure._azure_openai_async_clients.values()]
+        await aclose_azure_openai_clients()
+        return response, clients
+
+    response, clients = asyncio.run(call())
+    assert response == 'prompt'
+    assert len(clients) == 1 and clients[0].is_closed()
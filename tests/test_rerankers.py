@@ -0,0 +1,66 @@
+import os
+import json
+import zlib
+import threading
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('llama_index.core')
+
+from llama_index.core.schema import TextNode, NodeWithScore
+from llama_index.core.storage.docstore.utils import doc_to_json
+
+from scp_utils.kb_store import EMBEDDINGS_FILE, EMBEDDING_IDS_FILE, DOCSTORE_SQLITE_FILE, _write_node_records, save_colbert_tokens, ColbertTokenStore
+from scp_utils.rerankers import BatchedReranker, ColbertReranker, export_colbert_token_embeddings
+
+
+class RecordingColbertReranker(ColbertReranker):
+    # records the texts it encodes instead of running the ColBERT model
+    def __init__(self):
+        BatchedReranker.__init__(self)
+        self.model_name = 'colbert-test'
+        self.doc_cache_size = 16
+        self.doc_cache = OrderedDict()
+        self.doc_cache_lock = threading.Lock()
+        self.token_stores = []
+        self.encoded_texts = []
+
+    def encode(self, texts):
+        self.encoded_texts += texts
+        return [np.ones((2, 4), dtype=np.float16) for _ in texts]
+
+
+def test_colbert_encodes_the_plain_node_text():
+    node = TextNode(id_='node-1', text='Colonoscopy one year after surgery.',
+                    metadata={'keywords': ['colonoscopy', 'surveillance'], 'doc_title': 'Colon cancer survivorship guideline'})
+    reranker = RecordingColbertReranker()
+    reranker.get_doc_token_embeddings([NodeWithScore(node=node, score=1.0)])
+    assert reranker.encoded_texts == ['Colonoscopy one year after surgery.']
+
+
+def test_token_store_is_exported_from_the_plain_node_text(tmp_path):
+    KB_path = str(tmp_path)
+    node = TextNode(id_='node-1', text='Colonoscopy one year after surgery.', metadata={'keywords': ['colonoscopy']})
+    # an exported KB with one node
+    np.save(os.path.join(KB_path, EMBEDDINGS_FILE), np.ones((1, 4), dtype=np.float16))
+    with open(os.path.join(KB_path, EMBEDDING_IDS_FILE), 'w') as f:
+        json.dump({'ids': [node.node_id], 'embed_model': 'test-model'}, f)
+    _write_node_records(os.path.join(KB_path, DOCSTORE_SQLITE_FILE), [(node.node_id, zlib.compress(json.dumps(doc_to_json(node)).encode('utf-8')))])
+    # a store of an earlier build, encoded from the text with its embed metadata
+    save_colbert_tokens(KB_path, ['node-1'], [np.zeros((3, 4), dtype=np.float16)], 'colbert-test', None)
+    reranker = RecordingColbertReranker()
+    assert not reranker.is_compatible(ColbertTokenStore(KB_path))
+
+    export_colbert_token_embeddings(KB_path, reranker)
+    token_store = ColbertTokenStore(KB_path)
+    assert reranker.encoded_texts == ['Colonoscopy one year after surgery.']
+    assert reranker.is_compatible(token_store) and token_store.get('node-1').shape == (2, 4)
+
+    # an up to date store is reused
+    other_reranker = RecordingColbertReranker()
+    export_colbert_token_embeddings(KB_path, other_reranker)
+    assert other_reranker.encoded_texts == []
+    reranker.add_token_store(ColbertTokenStore(KB_path))
+    assert len(reranker.token_stores) == 1